@@ -0,0 +1,107 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from itertools import chain
+import logging
+import threading
+
+from bndl.net.connection import NotConnected
+
+
+logger = logging.getLogger(__name__)
+
+
+def worker_tree(nodes, fanout):
+    '''
+    Arrange nodes in a tree with fanout children per node (the first node is the root).
+
+    :param nodes: sequence
+        A sequence of (worker name, partition indices) tuples.
+    :param fanout: int
+        The (maximum) number of children per node.
+    :return: A (worker name, partition indices, children) tuple for the root, where children
+        is a list of such tuples.
+    '''
+    def subtree(idx):
+        name, part_idxs = nodes[idx]
+        children = range(idx * fanout + 1, min(idx * fanout + fanout + 1, len(nodes)))
+        return name, part_idxs, [subtree(child) for child in children]
+    return subtree(0)
+
+
+
+class AggregateManager(object):
+    '''
+    Keeps the partial aggregates of the partitions computed by a worker until they are combined
+    along a tree of workers (see Dataset.tree_aggregate). Each worker combines the partial
+    aggregates of its partitions with the aggregates of its children in the tree and returns
+    the result to its parent, the root returns the result to the driver.
+    '''
+    def __init__(self, worker):
+        self.worker = worker
+        # partial aggregates structured as:
+        # - dict keyed by: aggregation id
+        # - tuple of a dict keyed by partition index and the comb function
+        self.partials = {}
+        self._lock = threading.Lock()
+
+
+    def add(self, agg_id, part_idx, partial, comb):
+        '''
+        Add the partial aggregate of a partition (locally, from within a task).
+
+        :param agg_id: The id of the aggregation.
+        :param part_idx: The index of the partition aggregated.
+        :param partial: The partial aggregate.
+        :param comb: callable(iterable)
+            The function to combine partial aggregates with.
+        '''
+        with self._lock:
+            partials, _ = self.partials.setdefault(agg_id, ({}, comb))
+            partials[part_idx] = partial
+
+
+    def reduce(self, src, agg_id, tree):
+        '''
+        Combine the partial aggregates of this worker and the aggregates of the children of this
+        worker in tree.
+
+        :param src: The (rmi) peer node requesting the reduction.
+        :param agg_id: The id of the aggregation.
+        :param tree: A (worker name, partition indices, children) tuple as produced by
+            worker_tree for this worker. Only the partial aggregates of the given partitions are
+            combined, partitions computed more than once are combined only once.
+        '''
+        _, part_idxs, children = tree
+
+        # request the aggregates of the children first, so they combine in parallel
+        requests = []
+        for child in children:
+            peer = self.worker.peers.get(child[0])
+            if peer is None or not peer.is_connected:
+                raise NotConnected('Worker %s of aggregation %s not connected' % (child[0], agg_id))
+            requests.append(peer.service('aggregate').reduce(agg_id, child))
+
+        with self._lock:
+            partials, comb = self.partials.pop(agg_id)
+
+        local = (partials[part_idx] for part_idx in part_idxs)
+        remote = (request.result() for request in requests)
+        return comb(chain(local, remote))
+
+
+    def clear(self, src, agg_id):
+        '''
+        Remove the partial aggregates of an aggregation (if any).
+        '''
+        with self._lock:
+            self.partials.pop(agg_id, None)
@@ -10,11 +10,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import Counter, defaultdict, deque, Iterable, Sized, OrderedDict
+from collections import Counter, defaultdict, deque, Iterable, Sized, OrderedDict, namedtuple
 from functools import partial, total_ordering, reduce
-from itertools import islice, product, chain, starmap, groupby
+from itertools import count, compress, islice, product, chain, starmap, groupby
 from math import sqrt, log, ceil
-from operator import add
+from operator import add, or_
+from uuid import uuid4
 import concurrent.futures
 import gzip
 import heapq
@@ -42,8 +43,10 @@ from bndl.execute.worker import task_context, current_worker
 from bndl.net.connection import NotConnected
 from bndl.rmi import InvocationException, root_exc
 from bndl.util import strings
+from bndl.util.bloom import BloomFilter
 from bndl.util.callsite import get_callsite, callsite, set_callsite
-from bndl.util.collection import is_stable_iterable, ensure_collection
+from bndl.util.collection import batch, is_stable_iterable, ensure_collection
+from bndl.util.conf import Float, Int
 from bndl.util.exceptions import catch
 from bndl.util.funcs import identity, getter, key_or_getter, partial_func
 from bndl.util.hash import portable_hash
@@ -55,13 +58,142 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 
+broadcast_join_threshold = Int(10000, desc='The maximum number of elements of a data set to '
+                                           'broadcast in a join with strategy=\'auto\'.')
+distinct_buffer = Int(1000000, desc='The maximum number of distinct elements kept in memory per '
+                                    'partition in distinct and count_distinct, beyond that the '
+                                    'elements are partitioned by hash and spilled to disk.')
+group_buffer = Int(1000000, desc='The maximum number of values of a group in group_by_key kept in '
+                                 'memory, larger groups are spilled to disk and are read back as they '
+                                 'are iterated over.')
+bloom_error_rate = Float(.01, desc='The false positive rate of the Bloom filter over the keys of '
+                                   'the other data set in a join with bloom_filter=True.')
+merge_buffer = Int(100000, desc='The maximum number of elements of a group kept in memory in a cogroup '
+                                'or join with strategy=\'merge\', the elements beyond are spilled to '
+                                'disk. Also the maximum number of pairs per output element of such a '
+                                'join.')
+
+
 def new_dset_id():
     return strings.random(8)
 
 
+def _same_func(a, b):
+    if a is b:
+        return True
+    elif isinstance(a, partial) and isinstance(b, partial):
+        return a.func is b.func and a.args == b.args and a.keywords == b.keywords
+    else:
+        return a == b
+
+
+
+def _hash_distinct(elements, key, buffer_size, file_id, memory, level=0):
+    '''
+    Select the distinct elements (by key) through a hash set (or dict if key is given). If more
+    than buffer_size distinct elements are found, the distinct elements found and the remaining
+    elements are partitioned by a hash of their key and the level into 16 ExternalLists (which
+    spill to disk), and the partitions are processed one by one (as in a grace hash join).
+
+    :return: An iterable of collections of distinct elements.
+    '''
+    from bndl.compute.storage import ExternalList
+
+    distinct = {} if key else set()
+    add = distinct.add if not key else (lambda element: distinct.setdefault(key(element), element))
+
+    elements = iter(elements)
+    # partition on 4 bits of the hash of (level, key), the hash of the key alone is what the
+    # shuffle partitioned on (and str / bytes keys have only 32 bit hashes); give up on splitting
+    # after 16 levels (e.g. if many distinct keys have the same hash)
+    if level < 16:
+        for element in elements:
+            add(element)
+            if len(distinct) > buffer_size:
+                break
+        else:
+            yield distinct.values() if key else distinct
+            return
+    else:
+        for element in elements:
+            add(element)
+        yield distinct.values() if key else distinct
+        return
+
+    logger.debug('spilling distinct elements of %s by hash at level %s', file_id, level)
+    parts = [ExternalList(max(1, buffer_size // 16), file_id + (level, idx), memory)
+             for idx in range(16)]
+    appends = [part.append for part in parts]
+    for k, element in (distinct.items() if key else zip(distinct, distinct)):
+        appends[portable_hash((level, k)) & 15](element)
+    distinct = None
+    for element in elements:
+        appends[portable_hash((level, key(element) if key else element)) & 15](element)
+
+    for idx, part in enumerate(parts):
+        parts[idx] = None
+        yield from _hash_distinct(part, key, buffer_size, file_id + (idx,), memory, level + 1)
+
+
+
+def _group_list(values, buffer_size, file_id):
+    '''
+    Collect values into a list, or into an ExternalList if there are more than buffer_size values.
+    The ExternalList spills to disk and is registered with the memory manager of the current
+    worker, a plain list is used until then to keep small groups cheap.
+    '''
+    values = iter(values)
+    group = list(islice(values, buffer_size))
+    if len(group) < buffer_size:
+        return group
+    for value in values:
+        from bndl.compute.storage import ExternalList
+        external = ExternalList(buffer_size, file_id, current_worker().memory)
+        external.extend(group)
+        external.append(value)
+        external.extend(values)
+        return external
+    return group
+
+
+
+class Partitioning(namedtuple('Partitioning', 'partitioner key pcount')):
+    '''
+    Describes how the elements of a data set are partitioned: element e is in partition
+    partitioner(key(e)) % pcount, or partitioner(e) % pcount if key is None.
+    '''
+    def matches(self, partitioner=None, key=None, pcount=None):
+        '''
+        Whether this partitioning is compatible with the given partitioner, key and pcount. None
+        is compatible with any partitioner or pcount.
+        '''
+        return ((partitioner is None or _same_func(self.partitioner, partitioner)) and
+                _same_func(self.key, key) and
+                (pcount is None or self.pcount == pcount))
+
+
+    def __eq__(self, other):
+        return (isinstance(other, Partitioning) and
+                self.matches(other.partitioner, other.key, other.pcount))
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+
 class Dataset(object):
     cleanup = None
     sync_required = False
+    # the Partitioning of the data set if known (e.g. after a shuffle)
+    partitioning = None
+    # called with the dependency locations when the tasks of a data set which
+    # requires synchronization have completed (if not None)
+    synchronize = None
+    # the names of the workers by partition index which hold the output of the
+    # tasks of a data set which requires synchronization, if the output is kept
+    # across jobs (if not None)
+    output_locs = None
 
     def __init__(self, ctx, src=None, dset_id=None):
         self.ctx = ctx
@@ -329,7 +461,7 @@ class Dataset(object):
         '''
         if func:
             func = partial(func, *args, **kwargs)
-        return self.map_partitions(partial(filter, func))
+        return self._preserve_partitioning(self.map_partitions(partial(filter, func)))
 
 
     def starfilter(self, func, *args, **kwargs):
@@ -344,7 +476,31 @@ class Dataset(object):
         Any extra \*args or \**kwargs are passed to func (args before element).
         '''
         func = partial_func(func, *args, **kwargs)
-        return self.map_partitions(lambda p: (e for e in p if func(*e)))
+        return self._preserve_partitioning(self.map_partitions(lambda p: (e for e in p if func(*e))))
+
+
+    def _preserve_partitioning(self, dset, keyed=False):
+        '''
+        Mark dset, derived from this data set through a transformation which keeps the elements
+        in their partitions, as partitioned like this data set. If keyed is True, the
+        transformation only keeps the keys of K, V pairs (e.g. map_values), and the partitioning
+        is only preserved if this data set is partitioned on these keys.
+        '''
+        partitioning = self.partitioning
+        if partitioning is not None and (not keyed or _same_func(partitioning.key, getter(0))):
+            dset.partitioning = partitioning
+        return dset
+
+
+    def _copartitioned(self, *others, key=None, partitioner=None, pcount=None):
+        '''
+        Whether this and the other data sets are partitioned alike on key (defaults to the keys
+        of K, V pairs) and compatible with the given partitioner and pcount.
+        '''
+        partitioning = self.partitioning
+        if partitioning is None or not partitioning.matches(partitioner, key or getter(0), pcount):
+            return False
+        return all(other.partitioning == partitioning for other in others)
 
 
     def mask_partitions(self, mask):
@@ -474,7 +630,8 @@ class Dataset(object):
             Transformation to apply to the values
         '''
         func = partial_func(func, *args, **kwargs)
-        return self.map_partitions(lambda p: ((k, func(v)) for k, v in p))
+        return self._preserve_partitioning(self.map_partitions(lambda p: ((k, func(v)) for k, v in p)),
+                                           keyed=True)
 
 
     def pluck_values(self, ind, default=None):
@@ -510,9 +667,10 @@ class Dataset(object):
         '''
         if func:
             func = partial_func(func, *args, **kwargs)
-            return self.map_partitions(lambda p: (kv for kv in p if func(kv[0])))
+            filtered = self.map_partitions(lambda p: (kv for kv in p if func(kv[0])))
         else:
-            return self.map_partitions(lambda p: (kv for kv in p if kv[0]))
+            filtered = self.map_partitions(lambda p: (kv for kv in p if kv[0]))
+        return self._preserve_partitioning(filtered)
 
 
     def filter_byvalue(self, func=None, *args, **kwargs):
@@ -525,9 +683,10 @@ class Dataset(object):
         '''
         if func:
             func = partial_func(func, *args, **kwargs)
-            return self.map_partitions(lambda p: (kv for kv in p if func(kv[1])))
+            filtered = self.map_partitions(lambda p: (kv for kv in p if func(kv[1])))
         else:
-            return self.map_partitions(lambda p: (kv for kv in p if kv[1]))
+            filtered = self.map_partitions(lambda p: (kv for kv in p if kv[1]))
+        return self._preserve_partitioning(filtered)
 
 
     @callsite()
@@ -699,11 +858,12 @@ class Dataset(object):
         return self.aggregate(partial(reduce, reduction))
 
 
-    def tree_aggregate(self, local, comb=None, depth=2, scale=None, **shuffle_opts):
+    def tree_aggregate(self, local, comb=None, depth=2, scale=None, strategy='workers',
+                       **shuffle_opts):
         '''
         Tree-wise aggregation by first applying local on each partition and
-        subsequently shuffling the data across workers in depth rounds and for
-        each round aggregating the data by applying comb.
+        subsequently combining the aggregated partitions by applying comb
+        along a tree in depth rounds.
 
         :param local: func(iterable)
             The aggregation function to apply to each partition.
@@ -712,16 +872,31 @@ class Dataset(object):
         :param depth:
             The number of iterations to apply the aggregation in.
         :param scale: int or None (default)
-            The factor by which to reduce the partition count in each round. If
-            None, the step is chosen such that each reduction of intermediary
-            results is roughly of the same size (the branching factor in the
-            tree is the same across the entire tree).
+            The factor by which to reduce the partition count (or the number of
+            workers) in each round. If None, the step is chosen such that each
+            reduction of intermediary results is roughly of the same size (the
+            branching factor in the tree is the same across the entire tree).
+        :param strategy: str
+            'workers' (the default) keeps the aggregated partitions on the
+            workers which computed them. Each worker combines its aggregated
+            partitions and those of its children in a tree of workers (with
+            scale children per worker) and only the root of the tree returns
+            the result to the driver. 'shuffle' combines the aggregated
+            partitions through aggregate_by_key in each round.
         '''
         if depth is None:
             depth = 16
         if depth < 2:
             return self.aggregate(local, comb)
 
+        if not comb:
+            comb = local
+
+        if strategy == 'workers':
+            return self._worker_tree_aggregate(local, comb, depth, scale)
+        elif strategy != 'shuffle':
+            raise ValueError('Unsupported tree aggregation strategy %r' % strategy)
+
         pcount = len(self.parts())
         if scale is None:
             scale = max(int(ceil(pow(pcount, 1.0 / depth))), 2)
@@ -731,9 +906,6 @@ class Dataset(object):
         if ipcount < 2:
             return self.aggregate(local, comb)
 
-        if not comb:
-            comb = local
-
         agg = self.map_partitions_with_index(lambda idx, p: [(idx % ipcount, local(p))])
 
         for _ in range(depth):
@@ -750,6 +922,50 @@ class Dataset(object):
             raise ValueError('dataset is empty')
 
 
+    def _worker_tree_aggregate(self, local, comb, depth, scale):
+        '''
+        Aggregate the partitions into the workers which computed them and combine the aggregates
+        along a tree of workers (see bndl.compute.aggregate). If the tree can't be combined, e.g.
+        because a worker was lost, the aggregation falls back to Dataset.aggregate.
+        '''
+        from bndl.compute.aggregate import worker_tree
+        agg_id = str(uuid4())
+
+        def add(idx, partition):
+            worker = current_worker()
+            worker.service('aggregate').add(agg_id, idx, local(partition), comb)
+            return [(idx, worker.name)]
+
+        try:
+            part_idxs = defaultdict(list)
+            for idx, worker in self.map_partitions_with_index(add).icollect(ordered=False):
+                part_idxs[worker].append(idx)
+
+            if not part_idxs:
+                try:
+                    return comb(iter(()))
+                except StopIteration:
+                    raise ValueError('dataset is empty')
+
+            nodes = sorted(part_idxs.items())
+            if scale is None:
+                scale = max(int(ceil(pow(len(nodes), 1.0 / depth))), 2)
+            tree = worker_tree(nodes, scale)
+
+            root = self.ctx.node.peers.get(tree[0])
+            try:
+                if root is None:
+                    raise NotConnected('Worker %s not connected' % tree[0])
+                return root.service('aggregate').reduce(agg_id, tree).result()
+            except (NotConnected, InvocationException):
+                logger.warning('Unable to combine tree aggregate %s on the workers, '
+                               'falling back to aggregate', agg_id, exc_info=True)
+                return self.aggregate(local, comb)
+        finally:
+            for worker in self.ctx.workers:
+                worker.service('aggregate').clear(agg_id)
+
+
     def tree_combine(self, zero, merge_value, merge_combs, **kwargs):
         '''
         Tree-wise version of Dataset.combine. See Dataset.tree_aggregate for details.
@@ -833,7 +1049,7 @@ class Dataset(object):
         '''
         Calculate count, mean, min, max, variance, stdev, skew and kurtosis of this dataset.
         '''
-        return self.aggregate(Stats, partial(reduce, add))
+        return self.tree_aggregate(Stats, partial(reduce, add))
 
 
     def mvstats(self, width=None):
@@ -885,11 +1101,10 @@ class Dataset(object):
         '''
         key = key_or_getter(key)
         return (self.key_by(key)
-                    .group_by_key(partitioner=partitioner, pcount=pcount, **shuffle_opts)
-                    .map_values(list))
+                    .group_by_key(partitioner=partitioner, pcount=pcount, **shuffle_opts))
 
 
-    def group_by_key(self, partitioner=None, pcount=None, **shuffle_opts):
+    def group_by_key(self, partitioner=None, pcount=None, sort_values=None, **shuffle_opts):
         '''
         Group a K, V dataset by K.
 
@@ -897,17 +1112,44 @@ class Dataset(object):
             The (optional) partitioner to apply.
         :param pcount:
             The number of partitions to group into.
+        :param sort_values: bool or callable(V)
+            If True (or a key function for the values) the values of each group are sorted
+            (on the key function) as part of the shuffle (a secondary sort).
+
+        If this data set is already partitioned by key (e.g. it's the output of aggregate_by_key)
+        with a compatible partitioner and pcount, the partitions are grouped without a shuffle.
+
+        The values of a group are collected in a list. Groups with more than
+        bndl.compute.dataset.group_buffer values, or which are spilled when the worker needs
+        memory, are ExternalLists instead: the values are kept on disk and read back when the
+        group is iterated over (which can be done more than once).
         '''
+        buffer_size = self.ctx.conf['bndl.compute.dataset.group_buffer']
         def strip_key(key, value):
-            return key, pluck(1, value)
-        return self._group_by_key(partitioner, pcount, **shuffle_opts).starmap(strip_key).map_values(list)
+            return key, _group_list(pluck(1, value), buffer_size, ('group_by_key',))
+        grouped = self._group_by_key(partitioner, pcount, sort_values, **shuffle_opts)
+        return grouped._preserve_partitioning(grouped.starmap(strip_key), True)
 
 
-    def _group_by_key(self, partitioner=None, pcount=None, **shuffle_opts):
+    def _group_by_key(self, partitioner=None, pcount=None, sort_values=None, **shuffle_opts):
         def _group_by_key(partition):
             return groupby(partition, key=getter(0))
-        return (self.shuffle(pcount, partitioner, key=getter(0), **shuffle_opts)
-                    .map_partitions(_group_by_key))
+
+        if not sort_values:
+            sort_key = getter(0)
+        else:
+            value_key = sort_values if callable(sort_values) else identity
+            def sort_key(element):
+                return element[0], value_key(element[1])
+
+        if self._copartitioned(partitioner=partitioner, pcount=pcount):
+            def _group_by_key(partition, group_by_key=_group_by_key):
+                return group_by_key(sorted(partition, key=sort_key))
+            shuffled = self
+        else:
+            shuffled = self.shuffle(pcount, partitioner, partition_key=getter(0), sort_key=sort_key,
+                                    **shuffle_opts)
+        return shuffled._preserve_partitioning(shuffled.map_partitions(_group_by_key), True)
 
 
     def aggregate_by_key(self, local, comb=None, partitioner=None, pcount=None, **shuffle_opts):
@@ -935,9 +1177,9 @@ class Dataset(object):
             for key, group in groupby(partition, key=getter(0)):
                 yield key, comb(pluck(1, group))
 
-        return (self.shuffle(pcount, partitioner, key=getter(0),
-                             comb=local_aggregation, **shuffle_opts)
-                    .map_partitions(merge_aggregations))
+        shuffled = self.shuffle(pcount, partitioner, key=getter(0),
+                                comb=local_aggregation, **shuffle_opts)
+        return shuffled._preserve_partitioning(shuffled.map_partitions(merge_aggregations), True)
 
 
     def combine_by_key(self, create, merge_value, merge_combs,
@@ -955,7 +1197,18 @@ class Dataset(object):
             The (optional) partitioner to apply.
         :param pcount:
             The number of partitions to combine into.
+
+        Unless sort=True is given, the values are combined in hash tables as they are shuffled
+        (both in the shuffle write and read), instead of being sorted and grouped. The output is
+        then not sorted by key.
         '''
+        if not shuffle_opts.get('sort') and not shuffle_opts.get('bucket'):
+            from .shuffle import CombiningBucket
+            shuffle_opts.pop('sort', None)
+            shuffle_opts.pop('bucket', None)
+            return self.shuffle(pcount, partitioner, bucket=CombiningBucket, key=getter(0),
+                                comb=(create, merge_value, merge_combs), **shuffle_opts)
+
         def merge_values(values):
             values = iter(values)
             merged = create(next(values))
@@ -987,15 +1240,19 @@ class Dataset(object):
 
         Example:
 
-            >>> ctx.range(12).map(lambda i: (i%3, 1)).reduce_by_key(lambda a, b: a+b).collect()
+            >>> sorted(ctx.range(12).map(lambda i: (i%3, 1)).reduce_by_key(lambda a, b: a+b).collect())
             [(0, 4), (1, 4), (2, 4)]
         '''
         return self.combine_by_key(identity, reduction, reduction, partitioner, pcount, **shuffle_opts)
 
 
-    def _cogroup(self, other, *others, key=None, partitioner=None, pcount=None, **shuffle_opts):
+    def _cogroup(self, other, *others, key=None, partitioner=None, pcount=None, hot_keys=None,
+                 **shuffle_opts):
         key = key_or_getter(key)
 
+        if hot_keys:
+            return self._salted_cogroup(other, key, hot_keys, partitioner, pcount, **shuffle_opts)
+
         rdds = []
         for idx, rdd in enumerate((self, other) + others):
             if key is None:
@@ -1003,10 +1260,100 @@ class Dataset(object):
             else:
                 rdds.append(rdd.map_partitions(lambda p, idx=idx: ((key(e), (idx, e)) for e in p)))
 
+        if self._copartitioned(other, *others, key=key, partitioner=partitioner, pcount=pcount):
+            # the data sets are partitioned alike, the partitions can be grouped pair wise
+            def local_group_by_key(*partitions):
+                return groupby(sorted(chain.from_iterable(partitions), key=getter(0)), key=getter(0))
+            from .zip import ZippedDataset
+            grouped = ZippedDataset(*rdds, comb=local_group_by_key)
+            grouped.partitioning = Partitioning(self.partitioning.partitioner, getter(0),
+                                                self.partitioning.pcount)
+            return grouped
+
         return UnionDataset(rdds)._group_by_key(partitioner, pcount, **shuffle_opts)
 
 
-    def cogroup(self, other, *others, key=None, partitioner=None, pcount=None, **shuffle_opts):
+    def _salted_cogroup(self, other, key, hot_keys, partitioner, pcount, **shuffle_opts):
+        '''
+        Cogroup with the elements of hot keys in this data set spread over multiple groups by
+        'salting' the key. The elements with a hot key in the other data set are replicated to each
+        of these groups. Groups are shuffled on (key, salt) pairs, the salt is stripped afterwards.
+
+        :param hot_keys: mapping[key, int]
+            The number of salts (groups) for each hot key.
+        '''
+        def salt(partition):
+            salts = count()
+            for element in partition:
+                if key is None:
+                    k, value = element
+                else:
+                    k, value = key(element), element
+                salt_count = hot_keys.get(k)
+                yield (k, next(salts) % salt_count if salt_count else 0), (0, value)
+
+        def replicate(partition):
+            for element in partition:
+                if key is None:
+                    k, value = element
+                else:
+                    k, value = key(element), element
+                for salt in range(hot_keys.get(k, 1)):
+                    yield (k, salt), (1, value)
+
+        # place the salted groups of a key in adjacent partitions
+        base_partitioner = partitioner or portable_hash
+        def salted_partitioner(salted_key):
+            k, salt = salted_key
+            return base_partitioner(k) + salt
+
+        def strip_salt(salted_key, group):
+            return salted_key[0], group
+
+        return (UnionDataset([self.map_partitions(salt), other.map_partitions(replicate)])
+                    ._group_by_key(salted_partitioner, pcount, **shuffle_opts)
+                    .starmap(strip_salt))
+
+
+    def _hot_keys(self, key, pcount):
+        '''
+        Sample the keys of this data set to find the keys which (are expected to) take up more
+        than the average size of a partition. Returns a dict with for these keys the number of
+        partitions to spread them over.
+        '''
+        with set_callsite(name='join.sampler'):
+            samples = self._sample(pcount * 20)
+        if not samples:
+            return {}
+        keys = map(key, samples) if key else pluck(0, samples)
+        total = len(samples)
+        return {k: min(ceil(frequency * pcount / total), pcount)
+                for k, frequency in Counter(keys).items()
+                if frequency * pcount > total}
+
+
+    def cogroup(self, other, *others, key=None, partitioner=None, pcount=None, strategy='shuffle',
+                **shuffle_opts):
+        '''
+        Group the elements of this and the other data sets by key into (key, [group, ...]) pairs
+        with a group (list) for every data set.
+
+        :param key: callable(element) or object
+            The callable which returns the key or an object used as index to get the key from
+            the elements. If None, the data sets must consist of K, V pairs and the groups
+            consist of the values.
+        :param strategy: str
+            'shuffle' (the default) shuffles the data sets together and groups the elements in
+            memory per key. 'merge' shuffles each data set sorted by key and merges the sorted
+            partitions; groups with more than bndl.compute.dataset.merge_buffer elements are
+            spilled to disk.
+        '''
+        if strategy == 'merge':
+            return self._merge_cogroup(other, *others, key=key, partitioner=partitioner,
+                                       pcount=pcount, **shuffle_opts)
+        elif strategy != 'shuffle':
+            raise ValueError('Unsupported cogroup strategy %r' % strategy)
+
         num_rdds = 2 + len(others)
 
         def local_cogroup(group):
@@ -1017,11 +1364,55 @@ class Dataset(object):
                 buckets[idx].append(value)
             return key, buckets
 
-        return (self._cogroup(other, *others, key=key, partitioner=partitioner, pcount=pcount, **shuffle_opts)
-                    .map(local_cogroup))
+        grouped = self._cogroup(other, *others, key=key, partitioner=partitioner, pcount=pcount,
+                                **shuffle_opts)
+        return grouped._preserve_partitioning(grouped.map(local_cogroup), True)
+
+
+    def _merge_cogroup(self, other, *others, key=None, partitioner=None, pcount=None,
+                       **shuffle_opts):
+        '''
+        Cogroup by shuffling each data set sorted by key (with the same partitioner and pcount)
+        and merging the sorted partitions pair wise. The groups are lists, or ExternalLists which
+        spill to disk beyond bndl.compute.dataset.merge_buffer elements.
+        '''
+        from .zip import ZippedDataset
+
+        key = key_or_getter(key)
+        pcount = pcount or len(self.parts())
+        buffer_size = self.ctx.conf['bndl.compute.dataset.merge_buffer']
+
+        shuffled = []
+        for rdd in (self, other) + others:
+            if key is not None:
+                rdd = rdd.map_partitions(lambda p: ((key(e), e) for e in p))
+            shuffled.append(rdd.shuffle(pcount, partitioner, key=getter(0), sort=True,
+                                        **shuffle_opts))
+
+        def merge_groups(*partitions):
+            streams = [groupby(partition, key=getter(0)) for partition in partitions]
+            heads = [next(stream, None) for stream in streams]
+            while True:
+                keys = [head[0] for head in heads if head is not None]
+                if not keys:
+                    break
+                k = min(keys)
+                groups = []
+                for idx, head in enumerate(heads):
+                    if head is not None and not k < head[0]:
+                        groups.append(_group_list(pluck(1, head[1]), buffer_size, ('cogroup',)))
+                        heads[idx] = next(streams[idx], None)
+                    else:
+                        groups.append([])
+                yield k, groups
+
+        grouped = ZippedDataset(*shuffled, comb=merge_groups)
+        grouped.partitioning = shuffled[0].partitioning
+        return grouped
 
 
-    def join(self, other, key=None, partitioner=None, pcount=None, **shuffle_opts):
+    def join(self, other, key=None, partitioner=None, pcount=None, skew=False, strategy='shuffle',
+             bloom_filter=False, **shuffle_opts):
         '''
         Join two datasets.
 
@@ -1034,6 +1425,32 @@ class Dataset(object):
             The (optional) partitioner to apply.
         :param pcount:
             The number of partitions to join into.
+        :param skew: bool
+            If True, the keys of this data set are sampled to find hot keys. The elements of these
+            keys are spread over multiple partitions and the elements of the other dataset for
+            these keys are replicated to these partitions. A hot key may then occur more than once
+            in the output, each time with a part of the joined pairs.
+        :param strategy: str
+            'shuffle' (the default) shuffles both data sets. 'broadcast' collects the other
+            data set into a hash table which is broadcast to the workers and joined with the
+            partitions of this data set without a shuffle; skew, partitioner, pcount and shuffle
+            options can't be given then. 'auto' uses the broadcast strategy if either data set
+            has at most bndl.compute.dataset.broadcast_join_threshold elements (which are
+            computed to find out) and the shuffle strategy otherwise; skew, partitioner, pcount
+            and the shuffle options only apply if the shuffle strategy is used. In a broadcast
+            join a key occurs in the output once per element of the data set which isn't
+            broadcast. 'merge' shuffles both data sets sorted by key and merges the sorted
+            partitions (see cogroup). The pairs are produced as a stream with at most
+            bndl.compute.dataset.merge_buffer pairs per output element, so a key may occur more
+            than once in the output. The groups of a key are spilled to disk if they are larger;
+            skew can't be given then.
+        :param bloom_filter: bool
+            If True, a Bloom filter is built over the keys of the other data set (which is
+            expected to be the smaller one) and broadcast to filter the elements of this data set
+            before they are shuffled. Elements whose key doesn't occur in the other data set are
+            then (mostly) dropped before the shuffle. The false positive rate of the filter is
+            bndl.compute.dataset.bloom_error_rate. Note that the other data set is computed
+            (counted) to size the filter.
 
         Example::
 
@@ -1046,8 +1463,136 @@ class Dataset(object):
             if all(groups):
                 yield key, list(product(*groups))
 
-        return (self.cogroup(other, key=key, partitioner=partitioner, pcount=pcount, **shuffle_opts)
-                    .flatmap(local_join))
+        if bloom_filter and strategy != 'broadcast':
+            return self._bloom_filtered(other, key_or_getter(key)).join(
+                other, key, partitioner, pcount, skew, strategy, **shuffle_opts)
+
+        if strategy == 'broadcast':
+            if skew or partitioner or pcount or shuffle_opts:
+                raise ValueError('skew, partitioner, pcount and shuffle options are not supported '
+                                 'in a join with strategy \'broadcast\'')
+            return self._broadcast_join(other.collect(), key_or_getter(key))
+        elif strategy == 'merge':
+            if skew:
+                raise ValueError('skew is not supported in a join with strategy \'merge\'')
+            return self._merge_join(other, key, partitioner, pcount, **shuffle_opts)
+        elif strategy == 'auto':
+            threshold = self.ctx.conf['bndl.compute.dataset.broadcast_join_threshold']
+            for small, large, swapped in ((other, self, False), (self, other, True)):
+                elements = small.take(threshold + 1)
+                if len(elements) <= threshold:
+                    return large._broadcast_join(elements, key_or_getter(key), swapped)
+        elif strategy != 'shuffle':
+            raise ValueError('Unsupported join strategy %r' % strategy)
+
+        if skew:
+            pcount = pcount or len(self.parts()) + len(other.parts())
+            shuffle_opts['hot_keys'] = self._hot_keys(key_or_getter(key), pcount)
+
+        grouped = self.cogroup(other, key=key, partitioner=partitioner, pcount=pcount,
+                               **shuffle_opts)
+        if shuffle_opts.get('hot_keys'):
+            return grouped.flatmap(local_join)
+        else:
+            return grouped._preserve_partitioning(grouped.flatmap(local_join), True)
+
+
+    def _bloom_filtered(self, other, key):
+        '''
+        Filter the elements of this data set on whether their key (probably) occurs in the other
+        data set with a broadcast Bloom filter over the keys of the other data set.
+
+        :param key: callable(element) or None
+            The callable which returns the join key, if None the elements are K, V pairs.
+        '''
+        key = key or getter(0)
+        error_rate = self.ctx.conf['bndl.compute.dataset.bloom_error_rate']
+        with set_callsite(name='join.bloom_filter'):
+            bloom = self.ctx.broadcast(other.bloom_filter(key, error_rate=error_rate))
+
+        def probe(partition):
+            contains = bloom.value.contains
+            # test the keys in batches, the hashes of a batch are computed vectorized
+            for elements in batch(partition, 10000):
+                yield from compress(elements, contains([key(element) for element in elements]))
+
+        return self._preserve_partitioning(self.map_partitions(probe))
+
+
+    def _merge_join(self, other, key, partitioner, pcount, **shuffle_opts):
+        '''
+        Join by merging the sorted partitions of this and the other data set, the pairs of a
+        key are produced in chunks of at most bndl.compute.dataset.merge_buffer pairs.
+
+        The groups of a key are joined in a block nested loop: the left values are taken in
+        blocks of merge_buffer values and the right group is iterated over once per block, so
+        a spilled right group is read from disk once per block instead of once per value.
+        '''
+        chunk_size = self.ctx.conf['bndl.compute.dataset.merge_buffer']
+
+        def local_join(group):
+            key, (left, right) = group
+            if not left or not right:
+                return
+            pairs = []
+            left = iter(left)
+            while True:
+                block = list(islice(left, chunk_size))
+                if not block:
+                    break
+                for right_value in right:
+                    for left_value in block:
+                        pairs.append((left_value, right_value))
+                        if len(pairs) >= chunk_size:
+                            yield key, pairs
+                            pairs = []
+            if pairs:
+                yield key, pairs
+
+        grouped = self._merge_cogroup(other, key=key, partitioner=partitioner, pcount=pcount,
+                                      **shuffle_opts)
+        return grouped._preserve_partitioning(grouped.flatmap(local_join), True)
+
+
+    def _broadcast_join(self, elements, key, swapped=False):
+        '''
+        Join the partitions of this data set with the given elements which are broadcast as a
+        hash table. The joined pairs are produced per element as the partitions are probed.
+
+        :param elements: iterable
+            The elements to join this data set with.
+        :param key: callable(element) or None
+            The callable which returns the join key, if None the elements are K, V pairs.
+        :param swapped: bool
+            If True the elements are the left side of the join, otherwise the right side.
+        '''
+        table = defaultdict(list)
+        for element in elements:
+            if key is None:
+                k, value = element
+            else:
+                k, value = key(element), element
+            table[k].append(value)
+        table = self.ctx.broadcast(dict(table))
+
+        def probe(partition):
+            lookup = table.value
+            for element in partition:
+                if key is None:
+                    k, value = element
+                else:
+                    k, value = key(element), element
+                matches = lookup.get(k)
+                if matches is not None:
+                    if swapped:
+                        yield k, [(match, value) for match in matches]
+                    else:
+                        yield k, [(value, match) for match in matches]
+
+        if key is None:
+            return self._preserve_partitioning(self.map_partitions(probe), True)
+        else:
+            return self.map_partitions(probe)
 
 
     def product(self, other, *others, func=product):
@@ -1058,14 +1603,28 @@ class Dataset(object):
         '''
         Select the distinct elements from this dataset.
 
+        The elements are deduplicated in a hash set (or dict by key) on both sides of the shuffle
+        without sorting. At most bndl.compute.dataset.distinct_buffer distinct elements per
+        partition are kept in memory, beyond that the elements are partitioned by hash and
+        spilled to disk.
+
         :param pcount:
             The number of partitions to shuffle into.
+        :param key: callable(element) or object
+            Select elements distinct by key instead of by the elements themselves.
 
         Example:
 
             >>> sorted(ctx.range(10).map(lambda i: i%2).distinct().collect())
             [0, 1]
         '''
+        return self._hash_distinct(pcount, key, **shuffle_opts).flatmap()
+
+
+    def _hash_distinct(self, pcount, key, **shuffle_opts):
+        '''
+        Shuffle into hash buckets and map each partition to collections of distinct elements.
+        '''
         key = key_or_getter(key)
 
         if key is not None:
@@ -1075,19 +1634,141 @@ class Dataset(object):
             from .shuffle import SetBucket
             bucket = SetBucket
 
-        shuffle = self.shuffle(pcount, bucket=bucket, key=key, comb=sorted, sort=True, **shuffle_opts)
+        shuffle = self.shuffle(pcount, bucket=bucket, key=key, sort=False, **shuffle_opts)
+        buffer_size = self.ctx.conf['bndl.compute.dataset.distinct_buffer']
 
-        def select_distinct(partition):
-            for _, group in groupby(partition, key=key):
-                yield next(group)
-        return shuffle.map_partitions(select_distinct)
+        def select_distinct(idx, partition):
+            file_id = ('distinct', shuffle.id, idx)
+            return _hash_distinct(partition, key, buffer_size, file_id, current_worker().memory)
+        return shuffle.map_partitions_with_index(select_distinct)
 
 
     def count_distinct(self, pcount=None, **shuffle_opts):
         '''
-        Count the distinct elements in this Dataset.
+        Count the distinct elements in this Dataset. The distinct elements are counted per
+        partition of the shuffle, only the counts are sent to the driver.
+        '''
+        return self._hash_distinct(pcount, None, **shuffle_opts).map(len).sum()
+
+
+    def subtract(self, other, pcount=None, **shuffle_opts):
+        '''
+        Select the elements in this data set which don't occur in the other data set (elements
+        occurring more than once in this data set are kept as such).
+
+        :param other: Dataset
+            The data set with the elements to remove.
+        :param pcount:
+            The number of partitions to shuffle into.
+
+        Example:
+
+            >>> sorted(ctx.range(10).subtract(ctx.range(3, 8)).collect())
+            [0, 1, 2, 8, 9]
+        '''
+        return self._tagged_set_op(other, None, False, False, pcount, **shuffle_opts)
+
+
+    def intersection(self, other, pcount=None, **shuffle_opts):
+        '''
+        Select the distinct elements which occur in both this and the other data set.
+
+        :param other: Dataset
+            The data set to intersect with.
+        :param pcount:
+            The number of partitions to shuffle into.
+
+        Example:
+
+            >>> sorted(ctx.range(10).intersection(ctx.range(5, 15)).collect())
+            [5, 6, 7, 8, 9]
+        '''
+        return self._tagged_set_op(other, None, True, True, pcount, **shuffle_opts)
+
+
+    def subtract_by_key(self, other, pcount=None, **shuffle_opts):
+        '''
+        Select the K, V pairs of this data set with a key which doesn't occur in the other data set
+        of K, V pairs.
+
+        :param other: Dataset
+            The data set of K, V pairs with the keys to remove.
+        :param pcount:
+            The number of partitions to shuffle into.
+
+        Example:
+
+            >>> sorted(ctx.range(5).key_by(str).subtract_by_key(ctx.collection([('1', 'a'), ('3', 'b')])).collect())
+            [('0', 0), ('2', 2), ('4', 4)]
         '''
-        return self.distinct(pcount, **shuffle_opts).count()
+        return self._tagged_set_op(other, getter(0), False, False, pcount, **shuffle_opts)
+
+
+    def intersect_by_key(self, other, pcount=None, **shuffle_opts):
+        '''
+        Select the K, V pairs of this data set with a key which occurs in the other data set of
+        K, V pairs (a semi-join).
+
+        :param other: Dataset
+            The data set of K, V pairs with the keys to select.
+        :param pcount:
+            The number of partitions to shuffle into.
+
+        Example:
+
+            >>> sorted(ctx.range(5).key_by(str).intersect_by_key(ctx.collection([('1', 'a'), ('3', 'b')])).collect())
+            [('1', 1), ('3', 3)]
+        '''
+        return self._tagged_set_op(other, getter(0), True, False, pcount, **shuffle_opts)
+
+
+    def _tagged_set_op(self, other, key, keep, distinct, pcount, **shuffle_opts):
+        '''
+        Select the elements of this data set by whether their key occurs in the other data set
+        through one shuffle of both data sets.
+
+        The elements are tagged as (hash of key, tag, key, element) tuples, where the tag is 0 for
+        the keys of the other data set (without the element) and 1 for the elements of this data
+        set. The tuples are shuffled sorted by hash and tag, so the keys of the other data set
+        with a given hash precede the elements of this data set and the elements are selected as
+        they stream by. Only the keys of the other data set which share a hash are held in
+        memory at once.
+
+        :param key: callable(element) or None
+            The key to compare on, if None the elements themselves are compared.
+        :param keep: bool
+            Whether to select the elements of which the key does (True) or doesn't (False) occur
+            in the other data set.
+        :param distinct: bool
+            Whether to select an element once per key.
+        '''
+        key = key or identity
+
+        def tagger(tag):
+            def tag_partition(partition):
+                for element in partition:
+                    k = key(element)
+                    yield portable_hash(k), tag, k, element if tag else None
+            return tag_partition
+
+        def select(partition):
+            for _, group in groupby(partition, key=getter(0)):
+                others = set()
+                selected = set()
+                for _, tag, k, element in group:
+                    if not tag:
+                        others.add(k)
+                    elif (k in others) == keep:
+                        if distinct:
+                            if k in selected:
+                                continue
+                            selected.add(k)
+                        yield element
+
+        tagged = UnionDataset([other.map_partitions(tagger(0)), self.map_partitions(tagger(1))])
+        shuffled = tagged.shuffle(pcount, partition_key=getter(0), sort_key=getter([0, 1]),
+                                  sort=True, **shuffle_opts)
+        return shuffled.map_partitions(select)
 
 
     def count_distinct_approx(self, error_rate=.05):
@@ -1104,7 +1785,42 @@ class Dataset(object):
         ).card()
 
 
-    def count_by_value(self, depth=1, **shuffle_opts):
+    def bloom_filter(self, key=None, capacity=None, error_rate=.01):
+        '''
+        Build a Bloom filter over (the keys of) the elements in this data set. A filter is built
+        per partition and the filters are merged (OR-ed) into one on the workers (see
+        tree_aggregate).
+
+        :param key: callable(element) or object
+            The callable which returns the key or an object used as index to get the key from the
+            elements to add to the filter. If None, the elements themselves are added.
+        :param capacity: int or None
+            The number of distinct keys the filter is sized for, if None the elements in this data
+            set are counted to find out.
+        :param error_rate: float
+            The false positive rate of the filter at capacity.
+        :return: bndl.util.bloom.BloomFilter
+
+        Example::
+
+            >>> bloom = ctx.range(0, 100, 2).bloom_filter()
+            >>> 42 in bloom, 43 in bloom
+            (True, False)
+        '''
+        key = key_or_getter(key)
+        if capacity is None:
+            capacity = self.count()
+
+        def local(partition):
+            bloom = BloomFilter(capacity, error_rate)
+            for elements in batch(partition, 10000):
+                bloom.update(list(map(key, elements)) if key else elements)
+            return bloom
+
+        return self.tree_aggregate(local, partial(reduce, or_))
+
+
+    def count_by_value(self, depth=2, **shuffle_opts):
         '''
         Count the occurrence of each distinct value in the data set.
         '''
@@ -1125,6 +1841,11 @@ class Dataset(object):
             ascending order.
         :param pcount:
             Optionally the number of partitions to sort into.
+        :param hd_distribution:
+            If True, the boundaries of the partitions are determined from a sample of the data
+            set taken after counting it. Otherwise (and unless the shuffle is pipelined or
+            adaptive) the boundaries are learned from samples taken while shuffling, so the data
+            set is computed only once.
 
         Example:
 
@@ -1137,7 +1858,7 @@ class Dataset(object):
             >>> ctx.range(5).key_by(lambda i: i-2).sort(key=1).sort().collect()
             [(-2, 0), (-1, 1), (0, 2), (1, 3), (2, 4)]
         '''
-        from bndl.compute.shuffle import RangePartitioner
+        from bndl.compute.shuffle import RangePartitioner, range_boundaries
         key = key_or_getter(key)
 
         if pcount is None:
@@ -1146,8 +1867,6 @@ class Dataset(object):
         if pcount == 1:
             return self.shuffle(pcount, key=key, **shuffle_opts)
 
-        point_count = pcount * 20
-
         if hd_distribution:
             dset_size = self.count()
             if dset_size == 0:
@@ -1155,62 +1874,82 @@ class Dataset(object):
             # sample to find a good distribution over buckets
             fraction = min(pcount * 20. / dset_size, 1.)
             samples = self.sample(fraction).collect()
-        else:
-            rng = np.random.RandomState()
-            def sampler(partition):
-                fraction = 0.1
-
-                if isinstance(partition, Sized):
-                    if len(partition) <= point_count:
-                        return partition
-                    else:
-                        fraction = point_count / len(partition)
-                        samples = sample_without_replacement(rng, fraction, partition)
-                else:
-                    samples1 = list(islice(partition, point_count))
-                    samples2 = sample_without_replacement(rng, fraction, partition)
-                    short = point_count - len(samples2)
-                    if short > 0:
-                        if len(samples1) < short:
-                            samples = samples1 + samples2
-                        else:
-                            rng.shuffle(samples1)
-                            samples = samples1[:short] + samples2
-                    elif short < 0:
-                        rng.shuffle(samples1)
-                        samples = samples1[:int(len(samples1) * fraction)] + samples2
-                if len(samples) > point_count:
-                    rng.shuffle(samples)
-                    return samples[:point_count]
-                else:
-                    return samples
+        elif shuffle_opts.get('pipelined') or shuffle_opts.get('adaptive'):
             with set_callsite(name='sort.sampler'):
-                samples = self.map_partitions(sampler).collect()
+                samples = self._sample(pcount * 20)
+        else:
+            # learn the boundaries at the barrier between shuffle write and read
+            partitioner = RangePartitioner(None, reverse)
+            return self.shuffle(pcount, partitioner=partitioner, key=key, **shuffle_opts)
 
         assert samples
 
         # apply the key function if any
         if key:
-            samples = set(map(key, samples))
-        # sort the samples to function as boundaries
-        samples = sorted(samples, reverse=reverse)
+            samples = map(key, samples)
         # take pcount - 1 points evenly spaced from the samples as boundaries
-        boundaries = [samples[len(samples) * (i + 1) // pcount] for i in range(pcount - 1)]
+        boundaries = range_boundaries(samples, pcount, reverse)
         # and use that in the range partitioner to shuffle
         partitioner = RangePartitioner(boundaries, reverse)
         return self.shuffle(pcount, partitioner=partitioner, key=key, **shuffle_opts)
 
 
-    def shuffle(self, pcount=None, partitioner=None, bucket=None, key=None, comb=None, sort=None, **opts):
+    def _sample(self, point_count):
+        '''
+        Sample (up to) point_count elements from each partition of this data set.
+        '''
+        rng = np.random.RandomState()
+        def sampler(partition):
+            fraction = 0.1
+
+            if isinstance(partition, Sized):
+                if len(partition) <= point_count:
+                    return partition
+                else:
+                    fraction = point_count / len(partition)
+                    samples = sample_without_replacement(rng, fraction, partition)
+            else:
+                samples1 = list(islice(partition, point_count))
+                samples2 = sample_without_replacement(rng, fraction, partition)
+                short = point_count - len(samples2)
+                if short > 0:
+                    if len(samples1) < short:
+                        samples = samples1 + samples2
+                    else:
+                        rng.shuffle(samples1)
+                        samples = samples1[:short] + samples2
+                elif short < 0:
+                    rng.shuffle(samples1)
+                    samples = samples1[:int(len(samples1) * fraction)] + samples2
+                else:
+                    samples = samples2
+            if len(samples) > point_count:
+                rng.shuffle(samples)
+                return samples[:point_count]
+            else:
+                return samples
+        return self.map_partitions(sampler).collect()
+
+
+    def shuffle(self, pcount=None, partitioner=None, bucket=None, key=None, comb=None, sort=None,
+                partition_key=None, sort_key=None, **opts):
         '''
         .. todo::
 
             Document shuffle
+
+        The data is partitioned on partition_key and sorted on sort_key, both default to key
+        (see ShuffleWritingDataset).
         '''
         key = key_or_getter(key)
-        from .shuffle import ShuffleReadingDataset, ShuffleWritingDataset, ListBucket
+        opts.update(partition_key=partition_key, sort_key=sort_key)
+        from .shuffle import ShuffleReadingDataset, ShuffleWritingDataset, ListBucket, RecordBucket
         if bucket is None and sort == False:
-            bucket = ListBucket
+            if self.ctx.conf['bndl.compute.shuffle.record_buckets'] and \
+                    opts.get('serialization', 'pickle') == 'pickle':
+                bucket = RecordBucket
+            else:
+                bucket = ListBucket
         shuffle = ShuffleWritingDataset(self, pcount, partitioner, bucket, key, comb, **opts)
         return ShuffleReadingDataset(shuffle, sort)
 
@@ -1532,10 +2271,22 @@ class Dataset(object):
 
         while stack:
             d = stack.popleft()
-            if d.sync_required:
+            if d.sync_required and getattr(d, 'pipelined', False):
+                # the tasks of this data set are scheduled without waiting for the
+                # tasks of the pipelined source, they'll pick up its output as it becomes
+                # available
+                groups, _ = d._generate_tasks(tasks, group + 1, max(groups, group + 1))
+            elif d.sync_required:
                 cached = d.cached and d._cache_locs
-                groups, dependencies = d._generate_tasks(tasks, group + 1, max(groups, group + 1))
-                barrier = BarrierTask(d.ctx, (d.id, len(dependencies)), group='hidden')
+                dependencies = d._kept_output_tasks(group + 1)
+                if dependencies:
+                    # the output is still available, the tasks (and their sources) are done
+                    for dependency in dependencies:
+                        tasks[dependency.id] = dependency
+                else:
+                    groups, dependencies = d._generate_tasks(tasks, group + 1, max(groups, group + 1))
+                barrier = BarrierTask(d.ctx, (d.id, len(dependencies)), group='hidden',
+                                      synchronize=d.synchronize)
                 tasks[barrier.id] = barrier
                 barrier.dependents = dset_tasks
                 barrier.dependencies = dependencies
@@ -1559,6 +2310,33 @@ class Dataset(object):
         return groups, dset_tasks
 
 
+    def _kept_output_tasks(self, group):
+        '''
+        Tasks for the partitions of this data set marked as done if the output of all of them is
+        kept (see Dataset.output_locs) on connected workers, or None otherwise.
+        '''
+        output_locs = self.output_locs
+        if not output_locs:
+            return None
+        parts = list(self.parts())
+        if any(part.idx not in output_locs for part in parts):
+            return None
+
+        peers = self.ctx.node.peers
+        for worker_name in set(output_locs.values()):
+            peer = peers.get(worker_name)
+            if not peer or not peer.is_connected:
+                return None
+
+        dset_tasks = []
+        for part in parts:
+            task = ComputePartitionTask(part, group=group)
+            task.executed_on.append(output_locs[part.idx])
+            task.mark_done()
+            dset_tasks.append(task)
+        return dset_tasks
+
+
     def _schedule(self):
         tasks = OrderedDict()
         groups, _ = self._generate_tasks(tasks, 1, 1)
@@ -2028,7 +2806,7 @@ class TransformingDataset(Dataset):
             callsite = get_callsite(__file__)
             # TODO name = self.callsite[0] + ' -> ' + name
             funcs = self.funcs + (func,)
-            dset = self._with(funcs=funcs, callsite=callsite)
+            dset = self._with(funcs=funcs, callsite=callsite, partitioning=None)
             dset._pickle_funcs()
             return dset
 
@@ -2074,9 +2852,10 @@ class BarrierTask(Task):
     be tracked. After introducing the BarrierTask, there are 1000 + 1000 + 1 tasks and 1000 + 1000
     dependencies to track.
     '''
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, synchronize=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.dependency_locations = None
+        self.synchronize = synchronize
 
     def execute(self, scheduler, worker):
         # administer where dependencies were executed
@@ -2088,6 +2867,8 @@ class BarrierTask(Task):
                 by_worker[executed_on] = locs = []
             part = dep.part
             locs.append((part.dset.id, part.idx))
+        if self.synchronize:
+            self.synchronize(by_worker)
         # 'execute' the barrier
         self.set_executing(worker)
         future = self.future = concurrent.futures.Future()
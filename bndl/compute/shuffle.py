@@ -10,31 +10,41 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from array import array
 from bisect import bisect_left
-from collections import defaultdict
-from concurrent.futures import Future
-from functools import lru_cache
-from itertools import chain
+from collections import defaultdict, deque, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, \
+    wait as wait_futures
+from functools import lru_cache, partial
+from itertools import chain, groupby, islice
 from math import ceil
-from operator import attrgetter
+from numbers import Integral
 from statistics import mean
 import gc
 import logging
-import os
+import pickle
+import random
+import struct
+import sys
+import threading
+import time
 
 from cytoolz.itertoolz import merge_sorted, pluck
+import numpy as np
 
 from bndl import rmi
-from bndl.compute.dataset import Dataset, Partition
-from bndl.compute.storage import StorageContainerFactory, InMemory
+from bndl.compute.dataset import Dataset, Partition, Partitioning
+from bndl.compute.storage import StorageContainerFactory, SerializedInMemory, DataFile, \
+    work_dir_stats
 from bndl.execute import DependenciesFailed, TaskCancelled
 from bndl.execute.worker import task_context
 from bndl.net.connection import NotConnected
 from bndl.rmi import InvocationException
 from bndl.util.collection import batch as batch_data, ensure_collection
-from bndl.util.conf import Float
-from bndl.util.funcs import star_prefetch
-from bndl.util.hash import portable_hash
+from bndl.util.conf import Bool, Float, Int
+from bndl.util.exceptions import catch
+from bndl.util.funcs import getter, identity, key_or_getter, prefetch, _getter
+from bndl.util.hash import portable_hash, portable_hashes
 
 
 logger = logging.getLogger(__name__)
@@ -42,6 +52,43 @@ logger = logging.getLogger(__name__)
 
 block_size_mb = Float(4, desc='Target (maximum) size (in megabytes) of blocks created by spilling'
                               '/ serializing elements to disk')
+pipeline_timeout = Float(60, desc='The maximum time (in seconds) a pipelined shuffle read waits for '
+                                  'the output of a source partition to become available.')
+adaptive_target_mb = Float(64, desc='The target size (in megabytes) of the partitions in an adaptive '
+                                    'shuffle read.')
+fetch_requests = Int(8, desc='The maximum number of outstanding requests for blocks in a shuffle read.')
+fetch_budget_mb = Float(64, desc='The maximum size (in megabytes) of the outstanding requests for blocks '
+                                 'in a shuffle read.')
+local_reads = Bool(True, desc='Whether shuffle reads from workers on the same host read the shuffle '
+                              'data from the work dir instead of receiving it over the network. Map '
+                              'outputs which are still in memory are written to the work dir for '
+                              'this (once per map output), which costs a disk write that reading '
+                              'over the network avoids.')
+merge_fan_in = Int(64, desc='The maximum number of sorted runs (spilled batches) merged at once in a '
+                            'shuffle read. More runs are merged in multiple passes through disk.')
+spill_buffers = Int(2, desc='The maximum number of spills of a shuffle write which are being written '
+                            'to disk in the background. If exceeded, the shuffle write waits until a '
+                            'spill is written.')
+keep_outputs = Bool(True, desc='Whether the outputs of a shuffle write are kept on the workers for as '
+                                'long as the shuffle data set exists on the driver, so that subsequent '
+                                'jobs which use it don\'t compute the shuffle write again. Otherwise '
+                                'the outputs are cleared when the job using them stops.')
+record_buckets = Bool(True, desc='Whether shuffles store homogeneous records (e.g. (str, int) tuples) '
+                                 'in columns by default (see RecordBucket). Only applies to shuffles '
+                                 'with pickle serialization.')
+
+
+def _object_size(sample):
+    '''
+    Estimate the memory footprint of an element from a sample: the size of the element objects
+    (and a pointer in a list) or the uncompressed pickled size for nested elements.
+    '''
+    if isinstance(sample, np.ndarray):
+        return max(1, sample.nbytes // len(sample))
+    shallow = sum(map(sys.getsizeof, sample)) // len(sample) + 8
+    pickled = len(pickle.dumps(sample, pickle.HIGHEST_PROTOCOL)) // len(sample)
+    return max(shallow, pickled)
+
 
 
 class Bucket:
@@ -49,10 +96,15 @@ class Bucket:
     Base bucket class. Implements spilling to disk / serializing (spilling) to memory. Any
     implementation must implement add(element) and extend(sequence). The sorted property
     indicates whether the elements in the buckets are considered sorted (and thus elements
-    from different buckets should be merge sorted in the shuffle read).
+    from different buckets should be merge sorted in the shuffle read). The combining property
+    indicates whether the buckets contain (key, combined) pairs which are to be merged key-wise
+    in the shuffle read. The splittable property indicates whether the output of a bucket may be
+    read by more than one task (in an adaptive shuffle read, see ShuffleWritingDataset).
     '''
 
     sorted = False
+    combining = False
+    splittable = False
 
     def __init__(self, bucket_id, key, comb, block_size_mb, memory_container, disk_container):
         self.id = bucket_id
@@ -67,6 +119,8 @@ class Bucket:
 
         # estimate of the size of an element (after combining)
         self.element_size = None
+        # estimate of the memory footprint of an element (before serialization)
+        self.object_size = None
 
 
     @property
@@ -82,6 +136,29 @@ class Bucket:
         return len(self) * (self.element_size or 1)
 
 
+    def estimate_size(self):
+        '''
+        Estimate the memory footprint of this bucket in bytes. Unlike memory_size, the footprint of
+        an element is estimated from the (uncompressed) size of a sample of the elements and not
+        from the size of serialized / spilled blocks.
+        '''
+        if not len(self):
+            return self.memory_size
+        if self.object_size is None:
+            sample = self._head(max(10, len(self) // 1000))
+            if not len(sample):
+                return self.memory_size
+            self.object_size = _object_size(sample)
+        return len(self) * self.object_size
+
+
+    def _head(self, count):
+        '''
+        The first (at most) count elements of this bucket.
+        '''
+        return list(islice(self, count))
+
+
     def _estimate_element_size(self, data):
         '''
         Estimate the size of a element from data.
@@ -95,9 +172,38 @@ class Bucket:
             c.clear()
 
 
-    def _to_blocks(self):
+    def extend_array(self, array):
+        '''
+        Add the rows of a numpy array. By default the rows are added as individual elements.
+        '''
+        self.extend(array)
+
+
+    def detach(self):
+        '''
+        Move the elements of this bucket into a new bucket of the same type and clear this
+        bucket. The new bucket shares the batches of spilled / serialized blocks with this
+        bucket.
+        '''
+        detached = self.__class__.__new__(self.__class__)
+        detached.__dict__.update(self.__dict__)
+        if isinstance(self, list):
+            list.extend(detached, list.__iter__(self))
+        elif isinstance(self, dict):
+            dict.update(detached, dict.items(self))
+        elif isinstance(self, set):
+            set.update(detached, set.__iter__(self))
+        self.clear()
+        return detached
+
+
+    def _combined(self):
         # apply combiner if any
-        data = ensure_collection(self.comb(self)) if self.comb else list(self)
+        return ensure_collection(self.comb(self)) if self.comb else list(self)
+
+
+    def _to_blocks(self):
+        data = self._combined()
         # and clear self
         self.clear()
 
@@ -109,11 +215,14 @@ class Bucket:
         block_size_recs = ceil(self.block_size_mb * 1024 * 1024 / self.element_size)
         if block_size_recs > len(data):
             return [data]
+        elif isinstance(data, np.ndarray):
+            # slice arrays so that each block is serialized as a contiguous buffer
+            return [data[i:i + block_size_recs] for i in range(0, len(data), block_size_recs)]
         else:
             return list(batch_data(data, block_size_recs))
 
 
-    def serialize(self, disk):
+    def serialize(self, disk, data_file=None):
         '''
         Serialize the elements in this bucket (not in the memory/disk blocks) to disk or in blocks
         in memory. The elements are serialized into a new batch of one ore more blocks
@@ -121,6 +230,9 @@ class Bucket:
 
         :param disk: bool
             Serialize to disk or memory.
+        :param data_file: DataFile or None
+            If given (and disk is True), the blocks are appended as segments to this file instead
+            of being written to a file per block.
         '''
         if not len(self):
             return 0
@@ -134,7 +246,10 @@ class Bucket:
         blocks_spilled = 0
         batch_no = len(self.batches)
 
-        Container = self.disk_container if disk else self.memory_container
+        if disk and data_file is not None:
+            Container = data_file.segment(self.disk_container)
+        else:
+            Container = self.disk_container if disk else self.memory_container
 
         blocks = self._to_blocks()
         while blocks:
@@ -183,19 +298,125 @@ class DictBucket(Bucket, dict):
 
 
 
+class CombiningBucket(Bucket, dict):
+    '''
+    Bucket for (key, value) pairs which combines the values per key as they are added (hash based
+    aggregation). The comb argument must be a (create, merge_value, merge_combs) tuple, where
+    create(value) creates a combined value from the first value for a key, merge_value(combined,
+    value) merges a value into a combined value and merge_combs(combined, combined) merges two
+    combined values. The bucket holds (key, combined) pairs.
+    '''
+    combining = True
+
+    def __init__(self, bucket_id, key, comb, *args, **kwargs):
+        super().__init__(bucket_id, key, None, *args, **kwargs)
+        self.create, self.merge_value, self.merge_combs = comb
+
+
+    def add(self, element):
+        key, value = element
+        try:
+            combined = self[key]
+        except KeyError:
+            self[key] = self.create(value)
+        else:
+            self[key] = self.merge_value(combined, value)
+
+
+    def extend(self, elements):
+        add = self.add
+        for element in elements:
+            add(element)
+
+
+    def __iter__(self):
+        return iter(self.items())
+
+
+    def _head(self, count):
+        return list(islice(dict.items(self), count))
+
+
+
+def _hash_key(element):
+    return portable_hash(element[0])
+
+
+
+class HashOrderedCombiningBucket(CombiningBucket):
+    '''
+    Combining bucket which is ordered by the hash of the key before spilling and iteration. This
+    allows merging spilled batches without requiring the keys to be orderable.
+    '''
+    def __iter__(self):
+        return iter(sorted(self.items(), key=_hash_key))
+
+
+
 class ListBucket(Bucket, list):
     '''
-    Plain bucket of elements.
+    Plain bucket of elements. Rows of numpy arrays added through extend_array are kept as
+    arrays (if there is no combiner) and are serialized as arrays.
     '''
+    splittable = True
+
     add = list.append
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.arrays = []
+        self.array_rows = 0
+
+
+    def extend_array(self, array):
+        if self.comb:
+            self.extend(array)
+        else:
+            self.arrays.append(array)
+            self.array_rows += len(array)
+
+
+    def __len__(self):
+        return list.__len__(self) + self.array_rows
+
+
+    def clear(self):
+        list.clear(self)
+        self.arrays = []
+        self.array_rows = 0
+
+
+    def _head(self, count):
+        if list.__len__(self):
+            return list.__getitem__(self, slice(count))
+        for rows in self.arrays:
+            if len(rows):
+                return rows[:count]
+        return []
+
+
+    def _combined(self):
+        if not self.arrays:
+            return super()._combined()
+        arrays = self.arrays
+        if list.__len__(self):
+            # elements were also added one by one, serialize these and the rows as a list
+            for rows in arrays:
+                self.extend(rows)
+            self.arrays = []
+            self.array_rows = 0
+            return super()._combined()
+        return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
 
 
 class SortedBucket(ListBucket):
     '''
-    List bucket which is sorted before spilling and iteration.
+    List bucket which is sorted on its key (the sort key of the shuffle) before spilling and
+    iteration.
     '''
     sorted = True
+    splittable = False
 
     def __iter__(self):
         self.sort()
@@ -205,19 +426,465 @@ class SortedBucket(ListBucket):
         self.sort()
         return super()._serialize_bucket(disk)
 
+    def _combined(self):
+        data = super()._combined()
+        if isinstance(data, np.ndarray):
+            keys = _array_keys(data, self.key)
+            if keys is None:
+                data = sorted(data, key=self.key)
+            else:
+                data = data[np.argsort(keys, kind='mergesort')]
+        return data
+
     def sort(self):
         return super().sort(key=self.key)
 
 
 
+class _Arena(object):
+    '''
+    Column of str or bytes values stored as one buffer with the (end) offsets of the values.
+    '''
+    def __init__(self, kind, data=None, ends=None):
+        self.kind = kind
+        self.data = bytearray() if data is None else data
+        self.ends = array('q') if ends is None else ends
+
+
+    def append(self, value):
+        self.data += value.encode() if self.kind is str else value
+        self.ends.append(len(self.data))
+
+
+    def pop(self):
+        self.ends.pop()
+        del self.data[self.ends[-1] if self.ends else 0:]
+
+
+    def extend(self, other):
+        offset = len(self.data)
+        self.data += other.data
+        self.ends.extend(end + offset for end in other.ends)
+
+
+    def __len__(self):
+        return len(self.ends)
+
+
+    def __getitem__(self, idx):
+        start = self.ends[idx - 1] if idx else 0
+        value = bytes(self.data[start:self.ends[idx]])
+        return value.decode() if self.kind is str else value
+
+
+    def __iter__(self):
+        start = 0
+        data = self.data
+        decode = self.kind is str
+        for end in self.ends:
+            value = bytes(data[start:end])
+            yield value.decode() if decode else value
+            start = end
+
+
+    def slice(self, start, stop):
+        offset = self.ends[start - 1] if start else 0
+        ends = self.ends[start:stop]
+        data = self.data[offset:ends[-1]] if ends else bytearray()
+        return _Arena(self.kind, data, array('q', (end - offset for end in ends)))
+
+
+    def take(self, order):
+        arena = _Arena(self.kind)
+        data = self.data
+        ends = self.ends
+        for idx in order:
+            arena.data += data[ends[idx - 1] if idx else 0:ends[idx]]
+            arena.ends.append(len(arena.data))
+        return arena
+
+
+    @property
+    def nbytes(self):
+        return len(self.data) + len(self.ends) * self.ends.itemsize
+
+
+    def __reduce__(self):
+        return _Arena, (self.kind, self.data, self.ends)
+
+
+
+_TYPECODES = {int: 'q', float: 'd'}
+
+
+def _column(kind):
+    if kind in _TYPECODES:
+        return array(_TYPECODES[kind])
+    else:
+        return _Arena(kind)
+
+
+def _take(column, order):
+    if isinstance(column, _Arena):
+        return column.take(order)
+    else:
+        return array(column.typecode, np.frombuffer(column, column.typecode)[order].tobytes())
+
+
+
+class Records(Sequence):
+    '''
+    Records (tuples) with the same number of fields and the same type (int, float, str or bytes)
+    per field, or scalars of one of these types, stored in columns. Integers and floats are
+    stored in arrays, str and bytes in one buffer per column. The records are pickled as these
+    (raw) buffers.
+    '''
+    def __init__(self, kinds, scalar, columns=None):
+        self.kinds = kinds
+        self.scalar = scalar
+        self.columns = columns if columns is not None else [_column(kind) for kind in kinds]
+
+
+    @classmethod
+    def for_element(cls, element):
+        '''
+        Create (empty) records for elements like element, or None if element is no such record.
+        '''
+        if type(element) is tuple:
+            kinds = tuple(map(type, element))
+            scalar = False
+        else:
+            kinds = (type(element),)
+            scalar = True
+        if kinds and all(kind in (int, float, str, bytes) for kind in kinds):
+            return cls(kinds, scalar)
+
+
+    def append(self, element):
+        '''
+        Append element and return True, or return False if element isn't like these records.
+        '''
+        if self.scalar:
+            values = (element,)
+        elif type(element) is not tuple or len(element) != len(self.kinds):
+            return False
+        else:
+            values = element
+        for kind, value in zip(self.kinds, values):
+            if type(value) is not kind:
+                return False
+        appended = 0
+        try:
+            for column, value in zip(self.columns, values):
+                column.append(value)
+                appended += 1
+        except (OverflowError, UnicodeEncodeError):
+            for column in self.columns[:appended]:
+                column.pop()
+            return False
+        return True
+
+
+    def extend(self, other):
+        '''
+        Append the records in other if they are like these records and return True, or return
+        False otherwise.
+        '''
+        if other.kinds != self.kinds or other.scalar != self.scalar:
+            return False
+        for column, other_column in zip(self.columns, other.columns):
+            column.extend(other_column)
+        return True
+
+
+    def __len__(self):
+        return len(self.columns[0])
+
+
+    def __iter__(self):
+        if self.scalar:
+            return iter(self.columns[0])
+        else:
+            return zip(*self.columns)
+
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            assert step == 1
+            columns = [column.slice(start, stop) if isinstance(column, _Arena) else column[start:stop]
+                       for column in self.columns]
+            return Records(self.kinds, self.scalar, columns)
+        elif self.scalar:
+            return self.columns[0][idx]
+        else:
+            return tuple(column[idx] for column in self.columns)
+
+
+    def sorted(self, key):
+        '''
+        The records sorted (stable) by key. The sort is vectorized if the key is the value of a
+        number column.
+        '''
+        column = None
+        if key is None and self.scalar:
+            column = self.columns[0]
+        elif isinstance(key, partial) and key.func is _getter and not key.keywords and \
+                not self.scalar and isinstance(key.args[0], int):
+            column = self.columns[key.args[0]]
+        if isinstance(column, array):
+            order = np.argsort(np.frombuffer(column, column.typecode), kind='mergesort')
+        else:
+            keys = list(self) if key is None else list(map(key, self))
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+        return Records(self.kinds, self.scalar, [_take(column, order) for column in self.columns])
+
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes if isinstance(column, _Arena) else len(column) * column.itemsize
+                   for column in self.columns)
+
+
+
+class RecordBucket(ListBucket):
+    '''
+    List bucket which stores homogeneous records (see Records) compactly in columns. If an
+    element is added which isn't like the records in the bucket, the records are converted into
+    a list of elements as in ListBucket.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.records = None
+
+
+    def add(self, element):
+        records = self.records
+        if records is None:
+            if not len(self):
+                records = self.records = Records.for_element(element)
+            if records is None:
+                list.append(self, element)
+                return
+        if not records.append(element):
+            self._unpack()
+            list.append(self, element)
+
+
+    def extend(self, elements):
+        if isinstance(elements, Records):
+            if not len(self):
+                self.records = Records(elements.kinds, elements.scalar)
+            if self.records is not None and self.records.extend(elements):
+                return
+        add = self.add
+        for element in elements:
+            add(element)
+
+
+    def extend_array(self, array):
+        if self.records is not None:
+            self._unpack()
+        super().extend_array(array)
+
+
+    def _unpack(self):
+        records = self.records
+        self.records = None
+        list.extend(self, records)
+
+
+    def __len__(self):
+        return super().__len__() + (len(self.records) if self.records is not None else 0)
+
+
+    def __iter__(self):
+        if self.records is not None:
+            return iter(self.records)
+        else:
+            return super().__iter__()
+
+
+    def clear(self):
+        super().clear()
+        self.records = None
+
+
+    @property
+    def memory_size(self):
+        if self.records is not None:
+            return self.records.nbytes
+        else:
+            return super().memory_size
+
+
+    def estimate_size(self):
+        if self.records is not None:
+            return self.records.nbytes
+        else:
+            return super().estimate_size()
+
+
+    def _combined(self):
+        if self.records is not None and not self.comb:
+            return self.records
+        else:
+            return super()._combined()
+
+
+
+class SortedRecordBucket(RecordBucket, SortedBucket):
+    '''
+    Record bucket which is sorted before spilling and iteration.
+    '''
+    def __iter__(self):
+        self.sort()
+        return super().__iter__()
+
+
+    def sort(self):
+        if self.records is not None:
+            self.records = self.records.sorted(self.key)
+        else:
+            SortedBucket.sort(self)
+
+
+    def _combined(self):
+        self.sort()
+        return super()._combined()
+
+
+
+_INVERT = bytes(range(255, -1, -1))
+_INTEGRAL = (Integral, np.bool_)
+_FLOATING = (float, np.floating)
+
+
+def encode_key(key):
+    '''
+    Encode a key into bytes which compare (byte wise) like the key itself. Supported are None,
+    int, float, bytes, str and tuples (or lists) of these. bool and numpy integers are encoded as
+    int and numpy floats as float. Keys of different types are ordered by type first (in the
+    order above), so ints and floats shouldn't be mixed.
+    '''
+    parts = []
+    _encode_key(key, parts.append)
+    return b''.join(parts)
+
+
+def _encode_key(key, write):
+    if key is None:
+        write(b'\x01')
+    elif isinstance(key, _INTEGRAL):
+        key = int(key)
+        if key >= 0:
+            magnitude = key.to_bytes((key.bit_length() + 7) // 8, 'big')
+            write(b'\x03')
+            write(len(magnitude).to_bytes(4, 'big'))
+            write(magnitude)
+        else:
+            # invert length and magnitude so that larger negative numbers order first
+            magnitude = (-key).to_bytes(((-key).bit_length() + 7) // 8, 'big')
+            write(b'\x02')
+            write((0xffffffff - len(magnitude)).to_bytes(4, 'big'))
+            write(magnitude.translate(_INVERT))
+    elif isinstance(key, _FLOATING):
+        bits, = struct.unpack('>Q', struct.pack('>d', key))
+        # flip the sign bit of positive numbers and all bits of negative numbers
+        bits = bits ^ 0xffffffffffffffff if bits >> 63 else bits | 0x8000000000000000
+        write(b'\x04')
+        write(bits.to_bytes(8, 'big'))
+    elif isinstance(key, (bytes, str)):
+        if isinstance(key, str):
+            write(b'\x06')
+            key = key.encode('utf-8', 'surrogatepass')
+        else:
+            write(b'\x05')
+        # escape null bytes and terminate with two null bytes so that a prefix orders first
+        write(key.replace(b'\x00', b'\x00\xff'))
+        write(b'\x00\x00')
+    elif isinstance(key, (tuple, list)):
+        write(b'\x07')
+        for k in key:
+            _encode_key(k, write)
+        write(b'\x00')
+    else:
+        raise TypeError('Unable to encode key of type %s' % type(key))
+
+
+
+_encoded_key = getter(0)
+
+
+class EncodedSortedBucket(SortedBucket):
+    '''
+    Sorted bucket which holds (encoded key, element) pairs with the key encoded with encode_key.
+    The bucket is sorted on the encoded keys and is serialized as (encoded key, pickled element)
+    pairs. In the shuffle read the pairs are merged on the encoded keys and the elements are
+    unpickled only as they are consumed. If the bucket has no key, the elements themselves are
+    encoded.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        key = self.key
+        if key is None:
+            self.encode = encode_key
+        else:
+            self.encode = lambda element: encode_key(key(element))
+
+
+    def add(self, element):
+        list.append(self, (self.encode(element), element))
+
+
+    def extend(self, elements):
+        encode = self.encode
+        list.extend(self, ((encode(element), element) for element in elements))
+
+    extend_array = extend
+
+
+    def __iter__(self):
+        self.sort()
+        return pluck(1, list.__iter__(self))
+
+
+    def sort(self):
+        return list.sort(self, key=_encoded_key)
+
+
+    def _combined(self):
+        if self.comb:
+            # combine the elements in order and encode the keys again
+            encode = self.encode
+            return [(encode(element), pickle.dumps(element, pickle.HIGHEST_PROTOCOL))
+                    for element in self.comb(self)]
+        else:
+            self.sort()
+            return [(encoded, pickle.dumps(element, pickle.HIGHEST_PROTOCOL))
+                    for encoded, element in list.__iter__(self)]
+
+
+def _decode_elements(pairs):
+    loads = pickle.loads
+    for _, element in pairs:
+        yield loads(element)
+
+
+
 class RangePartitioner():
     '''
     A partitioner which puts elements in a bucket based on a (binary) search for a position
     in the given (sorted) boundaries.
+
+    If boundaries is None, the boundaries are learned while shuffling: the shuffle write tasks
+    keep a sorted run and a sample of the keys of their partition and the boundaries are derived
+    from the samples once all shuffle write tasks have completed (see
+    ShuffleWritingDataset.learns_boundaries).
     '''
     def __init__(self, boundaries, reverse=False):
         self.boundaries = boundaries
-        self.n_boundaries = len(boundaries)
+        self.n_boundaries = len(boundaries) if boundaries is not None else 0
         self.reverse = reverse
         if reverse:
             self.__call__ = self.partition_reversed
@@ -229,6 +896,71 @@ class RangePartitioner():
         boundary = bisect_left(self.boundaries, value)
         return self.n_boundaries - boundary
 
+    def set_boundaries(self, boundaries):
+        self.boundaries = boundaries
+        self.n_boundaries = len(boundaries)
+
+    def __eq__(self, other):
+        # boundaries yet to be learned are only equal to themselves
+        return self is other or (isinstance(other, RangePartitioner) and
+                                 self.reverse == other.reverse and
+                                 self.boundaries is not None and
+                                 self.boundaries == other.boundaries)
+
+
+
+def range_boundaries(samples, pcount, reverse=False):
+    '''
+    Select pcount - 1 boundaries for a RangePartitioner evenly spaced from the sorted sample
+    keys. Duplicate keys are kept, so that keys which occur often take up (most of) a partition.
+    '''
+    samples = sorted(samples, reverse=reverse)
+    if not samples:
+        return []
+    return [samples[len(samples) * (i + 1) // pcount] for i in range(pcount - 1)]
+
+
+
+def _array_keys(array, key):
+    '''
+    Get the keys of the rows in a numpy array as an array, or None if key can't be applied to the
+    array as a whole. Supported are no key (1 dimensional arrays) and getter(index) for a column of
+    a 2 dimensional array or a field of a structured array.
+    '''
+    if key is None:
+        return array if array.ndim == 1 and not array.dtype.names else None
+    if not isinstance(key, partial) or key.func is not _getter or key.keywords:
+        return None
+    index = key.args[0]
+    if array.dtype.names:
+        if isinstance(index, int):
+            index = array.dtype.names[index]
+        return array[index] if index in array.dtype.names else None
+    elif array.ndim == 2 and isinstance(index, int):
+        return array[:, index]
+    else:
+        return None
+
+
+def _array_buckets(partitioner, keys):
+    '''
+    Vectorized version of partitioner applied to each of the keys in an array. The bucket indices
+    are returned as an array, or None if the partitioner or the keys aren't supported. Supported are
+    (non-reversed) range partitioners with numeric boundaries and keys and portable_hash for integer
+    keys.
+    '''
+    if keys.dtype.kind not in 'biuf':
+        return None
+    if isinstance(partitioner, RangePartitioner):
+        boundaries = np.asarray(partitioner.boundaries)
+        if partitioner.reverse or boundaries.dtype.kind not in 'biuf':
+            return None
+        return np.searchsorted(boundaries, keys, side='left')
+    elif partitioner is portable_hash and keys.dtype.kind in 'bi':
+        return portable_hashes(keys)
+    else:
+        return None
+
 
 
 class ShuffleWritingDataset(Dataset):
@@ -244,7 +976,8 @@ class ShuffleWritingDataset(Dataset):
 
 
     def __init__(self, src, pcount, partitioner=None, bucket=None, key=None, comb=None, *,
-            block_size_mb=None, serialization='pickle', compression='lz4'):
+            partition_key=None, sort_key=None, block_size_mb=None, serialization='pickle',
+            compression='lz4', pipelined=False, adaptive=False):
         '''
         :param src: Dataset
             Dataset to be shuffled.
@@ -253,12 +986,19 @@ class ShuffleWritingDataset(Dataset):
         :param partitioner: fun(element): int or None
             The partitioner to use. Defaults to portable_hash
         :param bucket: Bucket or None
-            The class of bucket to use, defaults to SortedBucket
+            The class of bucket to use, defaults to SortedRecordBucket (or SortedBucket if
+            bndl.compute.shuffle.record_buckets is False or serialization isn't 'pickle').
         :param key: fun(element): obj or None
             The key function to apply to each element. The output is used to partition (and sort
             if applicable) the data on.
+        :param partition_key: fun(element): obj or None
+            The key function to partition the data on, defaults to key.
+        :param sort_key: fun(element): obj or None
+            The key function to sort the data on (within a partition), defaults to key. This is
+            the key given to the buckets.
         :param comb: fun(sequence): iterable or None
-            Optional combiner to apply on a bucket before serialization.
+            Optional combiner to apply on a bucket before serialization. For a CombiningBucket
+            this is a (create, merge_value, merge_combs) tuple.
         :param block_size_mb: float or None
             The size of the blocks to produce in serializing the shuffle data. Defaults to
             bndl.compute.shuffle.block_size_mb.
@@ -267,55 +1007,327 @@ class ShuffleWritingDataset(Dataset):
             'pickle', 'marshal', 'text', 'binary', 'json', etc. Defaults to 'pickle'.
         :param compression: str or None
             A string compatible to the compression parameter of StorageContainerFactory. E.g. 'gzip'.
+        :param pipelined: bool
+            If True, the tasks of the shuffle read don't wait for all shuffle write tasks to
+            complete, but are scheduled (when workers are available) alongside the shuffle write
+            tasks and fetch the output of the shuffle write tasks as these complete. The reading
+            tasks fail if no new output becomes available within
+            bndl.compute.shuffle.pipeline_timeout seconds, e.g. because a worker was lost.
+        :param adaptive: bool
+            If True, the partitions to read are planned once all shuffle write tasks have
+            completed, based on the size of the buckets. Adjacent partitions which together are
+            smaller than bndl.compute.shuffle.adaptive_target_mb are read by one task (the others
+            are left empty). If the bucket type is splittable (e.g. ListBucket) the buckets of
+            oversized partitions are split by source partition over the tasks left empty. The
+            number of partitions doesn't change.
         '''
         super().__init__(src.ctx, src)
         self.pcount = pcount or len(src.parts())
         self.comb = comb
         self.partitioner = partitioner or portable_hash
-        self.bucket = bucket or SortedBucket
+        if bucket is None:
+            # records are serialized as such, which only pickle supports
+            if src.ctx.conf['bndl.compute.shuffle.record_buckets'] and serialization == 'pickle':
+                bucket = SortedRecordBucket
+            else:
+                bucket = SortedBucket
+        self.bucket = bucket
         self.key = key
+        self.partition_key = key_or_getter(partition_key) or key
+        self.sort_key = key_or_getter(sort_key) or key
 
         self.block_size_mb = block_size_mb or src.ctx.conf['bndl.compute.shuffle.block_size_mb']
         self.serialization = serialization
         self.compression = compression
+        self.pipelined = pipelined
+        self.adaptive = adaptive
+        # the plan for the shuffle read, see _plan
+        self.plan = None
+        # the workers which hold the outputs by partition index, see Dataset.output_locs
+        # (the output of a pipelined shuffle is read while it is written, so it isn't kept)
+        keep_outputs = src.ctx.conf['bndl.compute.shuffle.keep_outputs'] and not pipelined
+        self.output_locs = {} if keep_outputs else None
+
+        if (pipelined or adaptive) and self.learns_boundaries:
+            raise ValueError('The boundaries of a RangePartitioner can\'t be learned in a '
+                             'pipelined or adaptive shuffle')
+        # the boundaries learned at the barrier, see learns_boundaries
+        self.learned_boundaries = None
+
+
+    @property
+    def learns_boundaries(self):
+        '''
+        Whether the boundaries of the (range) partitioner are to be learned at the barrier
+        between shuffle write and read. The shuffle write tasks then write their partition as
+        one (unsorted) run and keep a sample of the partition keys. At the barrier the boundaries
+        are derived from the samples. The runs are partitioned into the buckets for the shuffle
+        read by the workers which hold them when the first task of the shuffle read asks for
+        them (see ShuffleManager.partition_runs), so the source is computed only once.
+        '''
+        return isinstance(self.partitioner, RangePartitioner) and self.partitioner.boundaries is None
+
+
+    @property
+    def cleanup(self):
+        # kept outputs are cleared when this data set is deleted
+        if self.output_locs is None:
+            return self._cleanup
+
+
+    def _cleanup(self, job):
+        self.clear_outputs()
+
+
+    def _kept_output_tasks(self, group):
+        # check whether the workers still hold the outputs (e.g. a worker may have restarted)
+        if self.output_locs and not self._outputs_available():
+            self.output_locs = {}
+        return super()._kept_output_tasks(group)
+
+
+    def _outputs_available(self):
+        peers = self.ctx.node.peers
+        expected = defaultdict(set)
+        for part_idx, worker_name in self.output_locs.items():
+            expected[worker_name].add(part_idx)
+
+        requests = []
+        for worker_name in expected:
+            peer = peers.get(worker_name)
+            if not peer or not peer.is_connected:
+                return False
+            requests.append((worker_name, peer.service('shuffle').get_output_sizes(self.id)))
+
+        for worker_name, request in requests:
+            try:
+                available = request.result()
+            except Exception:
+                logger.info('Unable to get shuffle output sizes for %s from %s',
+                            self.id, worker_name, exc_info=True)
+                return False
+            if not expected[worker_name].issubset(available):
+                return False
+        return True
+
+
+    def clear_outputs(self):
+        '''
+        Clear the outputs of the shuffle write on the workers.
+        '''
+        self.plan = None
+        if self.output_locs:
+            self.output_locs = {}
+        requests = [worker.service('shuffle').clear_bucket(self.id)
+                    for worker in self.ctx.workers]
+#         for request in requests:
+#             request.result()
+
+
+    def __del__(self):
+        if getattr(self, 'output_locs', None):
+            try:
+                node = None
+                with catch(RuntimeError):
+                    node = self.ctx.node
+                if node and node.node_type == 'driver':
+                    self.clear_outputs()
+            except:
+                logger.exception('Unable to clear shuffle outputs')
+        super().__del__()
+
+
+    @property
+    def synchronize(self):
+        if self.learns_boundaries:
+            return self._learn_boundaries
+        elif self.adaptive:
+            return self._plan
+
+
+    def _learn_boundaries(self, dependency_locations):
+        '''
+        Derive the boundaries of the range partitioner from the key samples of the shuffle write
+        tasks. The runs are partitioned by the workers once the shuffle read asks for them, not
+        here (this is executed by the scheduler). Workers which can't be reached are skipped,
+        the shuffle read will fail on the missing dependencies and the shuffle write tasks are
+        re-executed with the learned boundaries.
+        '''
+        if not self.learns_boundaries:
+            return
+
+        peers = self.ctx.node.peers
+        workers = [peers.get(worker_name) for worker_name in dependency_locations]
+        workers = [worker for worker in workers if worker and worker.is_connected]
+
+        samples = []
+        for request in [worker.service('shuffle').get_output_samples(self.id)
+                        for worker in workers]:
+            try:
+                samples.extend(request.result())
+            except Exception:
+                logger.warning('Unable to get key samples for %s', self.id, exc_info=True)
+
+        boundaries = range_boundaries(samples, self.pcount, self.partitioner.reverse)
+        self.partitioner.set_boundaries(boundaries)
+        self.learned_boundaries = boundaries
+
+
+    def _plan(self, dependency_locations):
+        '''
+        Plan which buckets the tasks of the shuffle read are to read from the bucket sizes of the
+        source partitions. The plan is kept until the job completes (also if shuffle write tasks
+        are re-executed) so that tasks of the shuffle read don't overlap.
+        '''
+        if self.plan is not None:
+            return
+
+        peers = self.ctx.node.peers
+        requests = []
+        for worker_name in dependency_locations:
+            peer = peers.get(worker_name)
+            if not peer or not peer.is_connected:
+                # the shuffle read will fail on missing dependencies
+                return
+            requests.append(peer.service('shuffle').get_output_sizes(self.id))
 
+        sizes = {}
+        for request in requests:
+            try:
+                sizes.update(request.result())
+            except Exception:
+                logger.warning('Unable to get shuffle output sizes for %s, '
+                               'shuffle read won\'t be adaptive', self.id, exc_info=True)
+                return
+
+        target_size = self.ctx.conf['bndl.compute.shuffle.adaptive_target_mb'] * 1024 * 1024
+        self.plan = plan_partitions(self.pcount, sizes, target_size, self.bucket.splittable)
+
+
+    def parts(self):
+        return [
+            ShuffleWritingPartition(self, i, p)
+            for i, p in enumerate(self.src.parts())
+        ]
+
+
+    @property
+    @lru_cache()
+    def disk_container(self):
+        return StorageContainerFactory('disk', self.serialization, self.compression)
+
+
+    @property
+    @lru_cache()
+    def memory_container(self):
+        return StorageContainerFactory('memory', self.serialization, self.compression)
+
+
+
+class SpillWriter(object):
+    '''
+    Writes (spills) buckets to disk in a background thread. The elements of the buckets are
+    detached from the buckets, so that elements can be added to the buckets while the detached
+    elements are written. At most max_pending spills are in flight, spill blocks until the oldest
+    spill is written if this limit is reached.
+    '''
+    def __init__(self, file_id, max_pending):
+        self.file_id = file_id
+        self.max_pending = max(1, max_pending)
+        self.pending = deque()
+        self.bytes_spilled = 0
+        self._executor = None
+
+
+    def spill(self, buckets):
+        '''
+        Write the elements in buckets into one data file in the background.
+        '''
+        while len(self.pending) >= self.max_pending:
+            self._wait(self.pending.popleft())
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+        detached = [bucket.detach() for bucket in buckets]
+        self.pending.append(self._executor.submit(self._write, detached))
+
+
+    def _write(self, detached):
+        data_file = DataFile(self.file_id)
+        spilled = 0
+        try:
+            # the element size re-estimated by serialize stays with the detached copy, the live
+            # bucket is being filled in the meantime
+            for elements in detached:
+                spilled += elements.serialize(True, data_file)
+        finally:
+            data_file.close()
+        return spilled
+
+
+    def _wait(self, future):
+        spilled = future.result()
+        self.bytes_spilled += spilled
+        logger.debug('spilled %.2f mb', spilled / 1024 / 1024)
+
+
+    def flush(self):
+        '''
+        Wait until all spills are written.
+        '''
+        while self.pending:
+            self._wait(self.pending.popleft())
 
-    @property
-    def cleanup(self):
-        return self._cleanup
 
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
 
-    def _cleanup(self, job):
-        requests = [worker.service('shuffle').clear_bucket(self.id)
-                    for worker in job.ctx.workers]
-#         for request in requests:
-#             request.result()
 
 
-    def parts(self):
-        return [
-            ShuffleWritingPartition(self, i, p)
-            for i, p in enumerate(self.src.parts())
-        ]
+class KeySample(object):
+    '''
+    A uniform sample of at most size keys (reservoir sampling).
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.keys = []
+        self.count = 0
+        self._rng = random.Random()
 
 
-    @property
-    @lru_cache()
-    def disk_container(self):
-        return StorageContainerFactory('disk', self.serialization, self.compression)
+    def add(self, key):
+        if self.count < self.size:
+            self.keys.append(key)
+        else:
+            idx = self._rng.randrange(self.count + 1)
+            if idx < self.size:
+                self.keys[idx] = key
+        self.count += 1
 
 
-    @property
-    @lru_cache()
-    def memory_container(self):
-        return StorageContainerFactory('memory', self.serialization, self.compression)
+    def sampled(self, data, key=None):
+        '''
+        Yield the elements from data while sampling their keys.
+        '''
+        add = self.add
+        for element in data:
+            add(key(element) if key else element)
+            yield element
 
 
 
 class ShuffleWritingPartition(Partition):
+    def save_cache_location(self, worker):
+        super().save_cache_location(worker)
+        # memorize where the output is kept (on the driver)
+        if self.dset.output_locs is not None:
+            self.dset.output_locs[self.idx] = worker
+
+
     def partitioner(self):
         # get / create the partitioner function possibly using a key function
-        key = self.dset.key
+        key = self.dset.partition_key
         if key:
             partitioner = self.dset.partitioner
             def part_(element):
@@ -325,77 +1337,356 @@ class ShuffleWritingPartition(Partition):
             return self.dset.partitioner
 
 
-    def _compute(self):
-        # ensure that partitioner is portable
-        if self.dset.partitioner is portable_hash:
-            assert (os.environ.get('PYTHONHASHSEED') or 'random') != 'random', \
-                'PYTHONHASHSEED must be set, otherwise shuffling will have incorrect output'
+    def _array_buckets(self, array, bucket_count):
+        '''
+        Compute the bucket index for each row in array at once, or None if the key and
+        partitioner of the data set can't be applied to the array as a whole.
+        '''
+        keys = _array_keys(array, self.dset.partition_key)
+        if keys is None:
+            return None
+        bucket_idxs = _array_buckets(self.dset.partitioner, keys)
+        if bucket_idxs is None:
+            return None
+        return bucket_idxs % bucket_count
+
+
+    def _scatter_array(self, array, bucket_idxs, buckets, memcheck):
+        '''
+        Divide the rows of array over the buckets with the given indices. The rows are added as
+        (contiguous) arrays if they can be serialized as such.
+        '''
+        # a stable sort keeps the order of the rows within each bucket
+        order = np.argsort(bucket_idxs, kind='mergesort')
+        ends = np.cumsum(np.bincount(bucket_idxs, minlength=len(buckets)))
+        array = array[order]
+        as_array = self.dset.serialization == 'pickle'
+        start = 0
+        for bucket, end in zip(buckets, ends):
+            if end > start:
+                rows = array[start:end]
+                if as_array:
+                    bucket.extend_array(rows)
+                else:
+                    bucket.extend(rows.tolist())
+                start = end
+                memcheck()
 
+
+    def _compute(self):
         logger.info('starting shuffle write of partition %r', self.id)
 
-        worker = self.dset.ctx.node
-        memory = worker.memory
+        data = self.src.compute()
+
+        if self.dset.learns_boundaries:
+            # write one run and sample the partition keys to learn the boundaries from, the run
+            # is sorted when it is partitioned (see _partition_run)
+            samples = KeySample(self.dset.pcount * 20)
+            run_bucket = RecordBucket if issubclass(self.dset.bucket, RecordBucket) else ListBucket
+            output = self._write(samples.sampled(data, self.dset.partition_key),
+                                 1, lambda element: 0, self.id + ('run',), run_bucket, None)
+            output.samples = samples.keys
+            output.part = self
+        else:
+            output = self._write(data, self.dset.pcount, self.partitioner(), self.id)
+
+        self.dset.ctx.node.service('shuffle').set_buckets(self, output)
+
+
+    def _partition_run(self, run):
+        '''
+        Partition the run written by this partition (when the boundaries were yet to be learned)
+        into the buckets for the shuffle read.
+
+        :param run: MapOutput
+            The output of this partition with the run as the only bucket.
+        '''
+        logger.info('partitioning run of partition %r', self.id)
+        self.dset.ctx.node.memory.remove_releasable(run.id)
+        data = (element
+                for batch in run.buckets[0]
+                for block in batch
+                for element in block.read())
+        return self._write(data, self.dset.pcount, self.partitioner(), self.id)
+
+
+    def _write(self, data, bucket_count, partitioner, output_id, bucket=None, comb=None):
+        '''
+        Divide the elements in data over bucket_count buckets with partitioner and serialize them
+        for the shuffle read.
+
+        :param output_id: tuple
+            The id of the MapOutput, the ids of the buckets and the spill files are derived from it.
+        :param bucket: Bucket or None
+            The class of bucket to use, defaults to the bucket (and comb) of the data set.
+        :return: MapOutput
+        '''
+        memory = self.dset.ctx.node.memory
+
+        if bucket is None:
+            bucket, comb = self.dset.bucket, self.dset.comb
 
         # create a bucket for each output partition
-        buckets = [self.dset.bucket((self.dset.id, self.idx, out_idx), self.dset.key,
-                                    self.dset.comb, self.dset.block_size_mb,
-                                    self.dset.memory_container, self.dset.disk_container)
-                   for out_idx in range(self.dset.pcount)]
+        buckets = [bucket(output_id + (out_idx,), self.dset.sort_key, comb,
+                          self.dset.block_size_mb, self.dset.memory_container,
+                          self.dset.disk_container)
+                   for out_idx in range(bucket_count)]
 
         bucket_add = [bucket.add for bucket in buckets]
-        bucket_count = len(buckets)
 
         bytes_serialized = 0
         elements_partitioned = 0
 
+        writer = SpillWriter(output_id + ('spill',), self.dset.ctx.conf['bndl.compute.shuffle.spill_buffers'])
+
         def spill(nbytes):
             if nbytes <= 0:
                 return 0
 
-            nonlocal bytes_serialized
-
-            buckets_by_size = sorted((b for b in buckets if len(b) > 0), key=attrgetter('memory_size'))
+            # estimate the size of the buckets, also when they haven't been serialized before
+            buckets_by_size = sorted((bucket.estimate_size(), idx)
+                                     for idx, bucket in enumerate(buckets) if len(bucket) > 0)
             if len(buckets_by_size) == 0:
                 return 0
 
+            # select the largest buckets to spill in this round
+            selected = []
             spilled = 0
             while buckets_by_size:
-                bucket = buckets_by_size.pop()
-                spilled += bucket.serialize(True)
+                size, idx = buckets_by_size.pop()
+                selected.append(buckets[idx])
+                spilled += size
                 if spilled >= nbytes:
                     break
 
-            gc.collect()
-
-            bytes_serialized += spilled
-            if spilled:
-                logger.debug('spilled %.2f mb', spilled / 1024 / 1024)
+            # and write them in the background, the elements are released when written
+            writer.spill(selected)
             return spilled
 
-        partitioner = self.partitioner()
-
-        with memory.async_release_helper(self.id, spill, priority=2) as memcheck:
-            # add each element to the bucket assigned to by the partitioner
-            # (limited by the bucket count and wrapped around)
-            for element in self.src.compute():
-                bucket_add[partitioner(element) % bucket_count](element)
-                elements_partitioned += 1
-                memcheck()
-
-            # serialize the buckets for shuffle read
-            for bucket in buckets:
-                bytes_serialized += bucket.serialize(False)
-                for batch in bucket.batches:
-                    for block in batch:
-                        if isinstance(block, InMemory):
-                            memory.add_releasable(block.to_disk, block.id, 0, block.size)
-                memcheck()
+        try:
+            with memory.async_release_helper(output_id, spill, priority=2) as memcheck:
+                # add each element to the bucket assigned to by the partitioner
+                # (limited by the bucket count and wrapped around)
+
+                # partition numpy arrays as a whole if possible
+                if isinstance(data, np.ndarray) and len(data):
+                    bucket_idxs = self._array_buckets(data, bucket_count)
+                    if bucket_idxs is not None:
+                        self._scatter_array(data, bucket_idxs, buckets, memcheck)
+                        elements_partitioned += len(data)
+                        data = ()
+
+                for element in data:
+                    bucket_add[partitioner(element) % bucket_count](element)
+                    elements_partitioned += 1
+                    memcheck()
+
+                # serialize the buckets for shuffle read (after the spills in flight)
+                writer.flush()
+                for bucket in buckets:
+                    bytes_serialized += bucket.serialize(False)
+                    memcheck()
+
+                # wait for the spills triggered while serializing
+                writer.flush()
+                bytes_serialized += writer.bytes_spilled
+        finally:
+            writer.close()
 
-        worker.service('shuffle').set_buckets(self, buckets)
+        # the serialized blocks can be moved to disk (into one data file) when memory is needed
+        output = MapOutput(output_id, buckets)
+        memory_size = output.memory_size
+        if memory_size:
+            memory.add_releasable(output.to_disk, output.id, 0, memory_size)
 
         logger.info('partitioned %s.%s of %s elem\'s, serialized %.1f mb',
                     self.dset.id, self.idx, elements_partitioned, bytes_serialized / 1024 / 1024)
 
+        return output
+
+
+
+def plan_partitions(pcount, sizes, target_size, split):
+    '''
+    Plan which buckets are read by which task in a shuffle read.
+
+    :param pcount: int
+        The number of partitions (and tasks) of the shuffle read.
+    :param sizes: mapping[int, sequence[int]]
+        The size in bytes of each bucket (per destination partition) per source partition.
+    :param target_size: int
+        The target size (in bytes) of the data to read per task.
+    :param split: bool
+        Whether buckets may be split by source partition.
+    :return: A list with for each partition a list of (destination partition index, source
+        partition indices) tuples. The source partition indices are None if all source partitions
+        are to be read.
+    '''
+    totals = [0] * pcount
+    for bucket_sizes in sizes.values():
+        for dest_part_idx, size in enumerate(bucket_sizes):
+            totals[dest_part_idx] += size
+
+    # coalesce adjacent partitions up to the target size
+    plan = [[] for _ in range(pcount)]
+    free = []
+    dest_part_idx = 0
+    while dest_part_idx < pcount:
+        start = dest_part_idx
+        size = totals[dest_part_idx]
+        dest_part_idx += 1
+        while dest_part_idx < pcount and size + totals[dest_part_idx] <= target_size:
+            size += totals[dest_part_idx]
+            dest_part_idx += 1
+        plan[start] = [(idx, None) for idx in range(start, dest_part_idx)]
+        free.extend(range(start + 1, dest_part_idx))
+
+    if not split:
+        return plan
+
+    # split oversized partitions by source partition over the partitions left empty
+    free.reverse()
+    src_parts = sorted(sizes.items())
+    for dest_part_idx in sorted(range(pcount), key=totals.__getitem__, reverse=True):
+        total = totals[dest_part_idx]
+        if not free or total <= target_size:
+            break
+        count = min(ceil(total / target_size), len(free) + 1)
+        chunks = [[]]
+        chunk_size = 0
+        for src_part_idx, bucket_sizes in src_parts:
+            size = bucket_sizes[dest_part_idx]
+            if chunk_size and chunk_size + size > total / count and len(chunks) < count:
+                chunks.append([])
+                chunk_size = 0
+            chunks[-1].append(src_part_idx)
+            chunk_size += size
+        if len(chunks) > 1:
+            plan[dest_part_idx] = [(dest_part_idx, chunks[0])]
+            for chunk in chunks[1:]:
+                plan[free.pop()] = [(dest_part_idx, chunk)]
+
+    return plan
+
+
+
+class MapOutput(object):
+    '''
+    The output of a shuffle write task: a list of batches of blocks per destination partition
+    (bucket). Blocks spilled to disk are segments of a data file per spill (round) and the blocks
+    serialized in memory are moved into a single data file when memory must be released. The
+    segments serve as the index of (destination partition, batch, offset, length) into these files.
+    '''
+    def __init__(self, part_id, buckets):
+        self.id = part_id
+        self.buckets = [bucket.batches for bucket in buckets]
+        self._lock = threading.Lock()
+        # the sample of partition keys and the partition which wrote the output if it is a
+        # run to be partitioned once the boundaries are learned, and a future which is done once
+        # the run is partitioned (see ShuffleManager.partition_runs)
+        self.samples = None
+        self.part = None
+        self.partitioned = None
+
+
+    def blocks(self):
+        for batches in self.buckets:
+            for batch in batches:
+                yield from batch
+
+
+    @property
+    def memory_size(self):
+        return sum(block.size for block in self.blocks()
+                   if isinstance(block, SerializedInMemory))
+
+
+    def to_disk(self):
+        with self._lock:
+            blocks = [block for block in self.blocks() if isinstance(block, SerializedInMemory)]
+            if blocks:
+                data_file = DataFile(self.id + ('serialized',))
+                for block in blocks:
+                    block.to_disk(data_file)
+                data_file.close()
+
+
+    def sizes(self):
+        '''
+        The size (in bytes) of the bucket for each destination partition.
+        '''
+        return [sum(block.size for batch in batches for block in batch)
+                for batches in self.buckets]
+
+
+    def __getitem__(self, dest_part_idx):
+        return self.buckets[dest_part_idx]
+
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+
+class BlockFetcher(object):
+    '''
+    Fetches blocks through multi-get requests from multiple sources. At most max_requests requests
+    are outstanding, issued round robin over the sources, and the requests outstanding are at most
+    budget bytes large (but at least one request is issued). The blocks are yielded as the
+    requests complete. The time spent waiting for requests to complete is kept in wait_time.
+
+    :param sources: sequence
+        A sequence of (worker, get_blocks, requests) tuples. get_blocks is called with the
+        coordinates of a request and returns a future. requests is a sequence of (coordinates,
+        size in bytes) tuples.
+    :param received: callable(worker, future): sequence
+        Called to get the blocks from a completed request.
+    :param max_requests: int
+        The maximum number of outstanding requests.
+    :param budget: int
+        The maximum size in bytes of the outstanding requests.
+    '''
+    def __init__(self, sources, received, max_requests, budget):
+        self.sources = sources
+        self.received = received
+        self.max_requests = max(1, max_requests)
+        self.budget = budget
+        self.wait_time = 0
+        self.requests = 0
+        self.bytes_received = 0
+
+
+    def __iter__(self):
+        queue = deque((worker, get_blocks, deque(requests))
+                      for worker, get_blocks, requests in self.sources if requests)
+        pending = {}
+        outstanding = 0
+
+        while queue or pending:
+            # issue requests round robin over the sources
+            while queue and len(pending) < self.max_requests:
+                worker, get_blocks, requests = queue[0]
+                coordinates, size = requests[0]
+                if pending and outstanding + size > self.budget:
+                    break
+                queue.popleft()
+                requests.popleft()
+                if requests:
+                    queue.append((worker, get_blocks, requests))
+                pending[get_blocks(coordinates)] = worker, size
+                outstanding += size
+                self.requests += 1
+
+            start = time.time()
+            done, _ = wait_futures(pending, return_when=FIRST_COMPLETED)
+            self.wait_time += time.time() - start
+
+            for request in done:
+                worker, size = pending.pop(request)
+                outstanding -= size
+                self.bytes_received += size
+                yield from self.received(worker, request)
+
 
 
 class ShuffleReadingDataset(Dataset):
@@ -411,6 +1702,13 @@ class ShuffleReadingDataset(Dataset):
         self.sorted = sorted
 
 
+    @property
+    def partitioning(self):
+        # an adaptive shuffle read doesn't keep the partitions as partitioned by the shuffle write
+        if not getattr(self.src, 'adaptive', False):
+            return Partitioning(self.src.partitioner, self.src.partition_key, self.src.pcount)
+
+
     @lru_cache()
     def parts(self):
         sources = self.src.parts()
@@ -471,37 +1769,51 @@ class ShuffleReadingPartition(Partition):
         return local_source, sources
 
 
-    def get_local_sizes(self):
+    def get_local_sizes(self, dest_part_idx=None):
+        if dest_part_idx is None:
+            dest_part_idx = self.idx
+
         node = self.dset.ctx.node
         shuffle_svc = node.service('shuffle')
+        local_sizes = shuffle_svc.get_bucket_sizes(node, self.dset.src.id, dest_part_idx)
+        return (node, self._get_local_blocks(), local_sizes)
 
-        # make it seem like fetching locally is remote
-        # so it fits in the stream_batch loop
-        def get_local_block(*args):
-            fut = Future()
-            try:
-                fut.set_result(shuffle_svc.get_bucket_blocks(node, *args))
-            except Exception as e:
-                fut.set_exception(e)
-            return fut
 
-        local_sizes = shuffle_svc.get_bucket_sizes(node, self.dset.src.id, self.idx)
-        return (node, get_local_block, local_sizes)
+    def get_sizes(self, buckets=None):
+        '''
+        Get the sizes of the blocks to read for buckets of (destination partition index, source
+        partition indices) tuples (by default the bucket of this partition from all source
+        partitions). The sources are resolved once and asked for the sizes of all buckets in one
+        request per source.
 
+        :return: A list with for every bucket a list of (worker, get_blocks, sizes) tuples.
+        '''
+        if buckets is None:
+            buckets = [(self.idx, None)]
+        elif not buckets:
+            return []
+        dest_part_idxs = [dest_part_idx for dest_part_idx, _ in buckets]
 
-    def get_sizes(self):
         dependency_locations = task_context()['dependency_locations']
         dependencies_missing = defaultdict(set)
 
         local_source, sources = self.get_sources()
         sizes = []
 
+        # partition the runs of the sources if the boundaries were learned at the barrier
+        boundaries = self.dset.src.learned_boundaries
+        if boundaries is not None:
+            self._partition_runs(local_source, sources, boundaries)
+
         # add the local fetch operations if the local node is a source
         if local_source:
-            sizes.append(self.get_local_sizes())
+            node = self.dset.ctx.node
+            local_sizes = node.service('shuffle').get_buckets_sizes(node, self.dset.src.id,
+                                                                    dest_part_idxs)
+            sizes.append((node, self._get_local_blocks(), local_sizes))
 
         # issue requests for the bucket bucket prep and get back sizes
-        size_requests = [worker.service('shuffle').get_bucket_sizes(self.dset.src.id, self.idx)
+        size_requests = [worker.service('shuffle').get_buckets_sizes(self.dset.src.id, dest_part_idxs)
                          for worker in sources]
 
         # wait for responses and zip with a function to get a block
@@ -513,36 +1825,47 @@ class ShuffleReadingPartition(Partition):
                 # mark all dependencies of worker as missing
                 dependencies_missing[worker.name] = set(dependency_locations[worker.name])
             except InvocationException:
-                logger.exception('Unable to compute bucket size %s.%s on %s' %
-                                 (self.dset.src.id, self.idx, worker.name))
+                logger.exception('Unable to compute bucket sizes %s.%s on %s' %
+                                 (self.dset.src.id, dest_part_idxs, worker.name))
                 raise
             except Exception:
-                logger.exception('Unable to compute bucket size %s.%s on %s' %
-                                 (self.dset.src.id, self.idx, worker.name))
+                logger.exception('Unable to compute bucket sizes %s.%s on %s' %
+                                 (self.dset.src.id, dest_part_idxs, worker.name))
                 raise
             else:
-                sizes.append((worker, worker.service('shuffle').get_bucket_blocks, size))
+                sizes.append((worker, self._get_blocks(worker), size))
 
         # if size info is missing for any source partitions, fail computing this partition
         # and indicate which tasks/parts aren't available. This assumes that the task ids
         # for the missing source partitions equals the ids of these partitions.
-        size_info_missing = set(range(self.src_count))
-        # keep track of where a source partition is available
-        source_locations = {}
-
-        for worker_idx, (worker, get_blocks, size) in enumerate(sizes):
-            selected = []
-            for src_part_idx, block_sizes in size:
-                if src_part_idx in size_info_missing:
-                    size_info_missing.remove(src_part_idx)
-                    source_locations[src_part_idx] = (worker, block_sizes)
-                    selected.append((src_part_idx, block_sizes))
-                else:
-                    other_worker, other_sizes = source_locations[src_part_idx]
-                    logger.warning('Source partition %r.%r available more than once, '
-                                   'at least at %s with block sizes %r and %s with block_sizes %r',
-                                   self.dset.src.id, src_part_idx, worker, block_sizes, other_worker, other_sizes)
-            sizes[worker_idx] = worker, get_blocks, selected
+        size_info_missing = set()
+        bucket_sizes = []
+
+        for bucket_idx, (dest_part_idx, src_part_idxs) in enumerate(buckets):
+            missing = set(range(self.src_count) if src_part_idxs is None else src_part_idxs)
+            # keep track of where a source partition is available
+            source_locations = {}
+            selected_sizes = []
+
+            for worker, get_blocks, size in sizes:
+                selected = []
+                for src_part_idx, block_sizes in size[bucket_idx]:
+                    if src_part_idxs is not None and src_part_idx not in src_part_idxs:
+                        continue
+                    elif src_part_idx in missing:
+                        missing.remove(src_part_idx)
+                        source_locations[src_part_idx] = (worker, block_sizes)
+                        selected.append((src_part_idx, block_sizes))
+                    else:
+                        other_worker, other_sizes = source_locations[src_part_idx]
+                        logger.warning('Source partition %r.%r available more than once, '
+                                       'at least at %s with block sizes %r and %s with block_sizes %r',
+                                       self.dset.src.id, src_part_idx, worker, block_sizes,
+                                       other_worker, other_sizes)
+                selected_sizes.append((worker, get_blocks, selected))
+
+            size_info_missing |= missing
+            bucket_sizes.append(selected_sizes)
 
         # translate size info missing into missing dependencies
         if size_info_missing:
@@ -570,78 +1893,221 @@ class ShuffleReadingPartition(Partition):
             batch_count = []
             block_count = []
             total_size = 0
-            for * _, parts in sizes:
-                for _, batches in parts:
-                    batch_count.append(len(batches))
-                    block_count.append(sum(len(block_sizes) for block_sizes in batches))
-                    total_size += sum(sum(block_sizes) for block_sizes in batches)
-            logger.info('shuffling %.1f mb (%s batches, %s blocks) from %s workers',
-                        total_size / 1024 / 1024, sum(batch_count), sum(block_count), len(batch_count))
-            logger.debug('batch count per source: min: %s, mean: %s, max: %s',
-                         min(batch_count), mean(batch_count), max(batch_count))
-            logger.debug('block count per source: min: %s, mean: %s, max: %s',
-                         min(block_count), mean(block_count), max(block_count))
+            for sizes in bucket_sizes:
+                for * _, parts in sizes:
+                    for _, batches in parts:
+                        batch_count.append(len(batches))
+                        block_count.append(sum(count for count, _ in batches))
+                        total_size += sum(size for _, size in batches)
+            if batch_count:
+                logger.info('shuffling %.1f mb (%s batches, %s blocks) from %s workers',
+                            total_size / 1024 / 1024, sum(batch_count), sum(block_count), len(batch_count))
+                logger.debug('batch count per source: min: %s, mean: %s, max: %s',
+                             min(batch_count), mean(batch_count), max(batch_count))
+                logger.debug('block count per source: min: %s, mean: %s, max: %s',
+                             min(block_count), mean(block_count), max(block_count))
+
+        return bucket_sizes
+
+
+    def _partition_runs(self, local_source, sources, boundaries):
+        '''
+        Have the source workers partition the runs written while the boundaries were yet to be
+        learned (see ShuffleWritingDataset.learns_boundaries). The workers do so in parallel,
+        only the first task of the shuffle read which asks a worker actually waits for it.
+        '''
+        src_dset_id = self.dset.src.id
+        requests = [(worker, worker.service('shuffle').partition_runs(src_dset_id, boundaries))
+                    for worker in sources]
+        if local_source:
+            node = self.dset.ctx.node
+            node.service('shuffle').partition_runs(node, src_dset_id, boundaries)
+        for worker, request in requests:
+            try:
+                request.result()
+            except NotConnected:
+                # the dependencies on the worker are marked as missing when getting the sizes
+                pass
+
+
+    def _get_local_blocks(self):
+        node = self.dset.ctx.node
+        shuffle_svc = node.service('shuffle')
+
+        # make it seem like fetching locally is remote
+        # so it fits in the stream_batch loop
+        def get_local_block(*args):
+            fut = Future()
+            try:
+                fut.set_result(shuffle_svc.get_bucket_blocks(node, *args))
+            except Exception as e:
+                fut.set_exception(e)
+            return fut
 
-        return sizes
+        return get_local_block
+
+
+    def _get_blocks(self, worker):
+        # read from the work dir of workers on the same host
+        shuffle_svc = worker.service('shuffle')
+        if self.dset.ctx.conf['bndl.compute.shuffle.local_reads'] and worker.islocal():
+            return shuffle_svc.get_local_bucket_blocks
+        else:
+            return shuffle_svc.get_bucket_blocks
 
 
     def blocks(self):
-        # batch fetches as 'multi-gets' to minimize the waiting on network I/O
+        plan = self.dset.src.plan
+        if plan is None:
+            buckets = [(self.idx, None)]
+        else:
+            buckets = plan[self.idx]
+        sources = []
+        for (dest_part_idx, _), sizes in zip(buckets, self.get_sizes(buckets)):
+            for worker, get_blocks, parts in sizes:
+                sources.append((worker, get_blocks, self._requests(parts, dest_part_idx)))
+        return self._fetch(sources)
+
+
+    def _requests(self, parts, dest_part_idx=None):
+        '''
+        Batch fetches of the blocks of the given source partitions as 'multi-gets' of at most
+        block_size_mb to minimize the waiting on network I/O.
+
+        :return: A list of (coordinates, size in bytes) tuples.
+        '''
         src_dset_id = self.dset.src.id
-        dest_part_idx = self.idx
+        if dest_part_idx is None:
+            dest_part_idx = self.idx
         block_size_b = self.dset.src.block_size_mb * 1024 * 1024
 
-        for worker, get_blocks, parts in self.get_sizes():
-            requests = []
-            request = []
-            request_size = 0
-
-            def new_batch():
-                nonlocal request, request_size
-                if request_size:
-                    requests.append((request,))
-                    request = []
-                    request_size = 0
-
-            for src_part_idx, batches in parts:
-                for batch_idx, block_sizes in enumerate(batches):
-                    for block_idx, block_size in enumerate(block_sizes):
-                        if request_size + block_size > block_size_b:
-                            new_batch()
-                        request.append((src_dset_id, src_part_idx, dest_part_idx, batch_idx, block_idx))
-                        request_size += block_size
-
-            new_batch()
-
-            # perform the multi-gets for this source and apply pre-fetching / read-ahead
-            for request in star_prefetch(get_blocks, requests):
+        requests = []
+        request = []
+        request_size = 0
+
+        def new_batch():
+            nonlocal request, request_size
+            if request_size:
+                requests.append((request, request_size))
+                request = []
+                request_size = 0
+
+        for src_part_idx, batches in parts:
+            for batch_idx, (block_count, batch_size) in enumerate(batches):
+                # the blocks in a batch are (approximately) of equal size
+                block_size = batch_size / block_count
+                for block_idx in range(block_count):
+                    if request_size + block_size > block_size_b:
+                        new_batch()
+                    request.append((src_dset_id, src_part_idx, dest_part_idx, batch_idx, block_idx))
+                    request_size += block_size
+
+        new_batch()
+        return requests
+
+
+    def _fetch(self, sources):
+        '''
+        Fetch the blocks from the sources, a sequence of (worker, get_blocks, requests) tuples.
+        '''
+        conf = self.dset.ctx.conf
+        fetcher = BlockFetcher(sources, self._received,
+                               conf['bndl.compute.shuffle.fetch_requests'],
+                               conf['bndl.compute.shuffle.fetch_budget_mb'] * 1024 * 1024)
+        yield from fetcher
+        if fetcher.requests:
+            logger.info('fetched %.1f mb in %s requests from %s sources, waited %.2f s',
+                        fetcher.bytes_received / 1024 / 1024, fetcher.requests,
+                        len(sources), fetcher.wait_time)
+
+
+    def _received(self, worker, request):
+        try:
+            return request.result()
+        except TaskCancelled:
+            raise
+        except NotConnected as exc:
+            # consider all data from the worker lost
+            dependency_locations = task_context()['dependency_locations'] or {}
+            if worker.name not in dependency_locations:
+                # pipelined shuffle, the dependencies aren't known by the scheduler
+                raise Exception('Unable to retrieve blocks from %s' % worker.name) from exc
+            raise DependenciesFailed({worker.name: dependency_locations[worker.name]})
+        except Exception:
+            logger.exception('unable to retrieve blocks from %s', worker.name)
+            raise
+
+
+    def pipelined_blocks(self):
+        '''
+        Stream in the blocks for this partition from the source partitions as their shuffle writes
+        complete. All workers are polled for (new) bucket sizes until the buckets of every source
+        partition have been read.
+        '''
+        node = self.dset.ctx.node
+        src_dset_id = self.dset.src.id
+        timeout = self.dset.ctx.conf['bndl.compute.shuffle.pipeline_timeout']
+
+        remaining = set(range(self.src_count))
+        interval = .01
+        waited = 0
+
+        while remaining:
+            # request the bucket sizes from all workers and get them locally
+            requests = [(worker, self._get_blocks(worker),
+                         worker.service('shuffle').get_bucket_sizes(src_dset_id, self.idx))
+                        for worker in node.peers.filter(node_type='worker')]
+            sizes = [self.get_local_sizes()]
+            for worker, get_blocks, request in requests:
                 try:
-                    blocks = request.result()
-                except TaskCancelled:
-                    raise
+                    sizes.append((worker, get_blocks, request.result()))
                 except NotConnected:
-                    # consider all data from the worker lost
-                    failed = task_context()['dependency_locations'][worker.name]
-                    raise DependenciesFailed({worker.name: failed})
-                except Exception:
-                    logger.exception('unable to retrieve blocks from %s', worker.name)
-                    raise
-                else:
-                    yield from blocks
-
+                    pass
+
+            # select the source partitions which weren't read yet
+            available = []
+            for worker, get_blocks, size in sizes:
+                selected = []
+                for src_part_idx, batches in size:
+                    if src_part_idx in remaining:
+                        remaining.remove(src_part_idx)
+                        selected.append((src_part_idx, batches))
+                if selected:
+                    available.append((worker, get_blocks, selected))
+
+            if available:
+                logger.debug('fetching %s source partitions, %s remaining',
+                             sum(len(parts) for *_, parts in available), len(remaining))
+                yield from self._fetch([(worker, get_blocks, self._requests(parts))
+                                        for worker, get_blocks, parts in available])
+                interval = .01
+                waited = 0
+            else:
+                if waited > timeout:
+                    raise Exception('No shuffle output of %r source partitions of %s available '
+                                    'after %.0f seconds' % (len(remaining), src_dset_id, waited))
+                time.sleep(interval)
+                waited += interval
+                interval = min(interval * 2, 1)
 
 
     def merge_sorted(self, blocks):
-        bucket = self.dset.src.bucket(
+        # (encoded key, pickled element) pairs are merged on the encoded key
+        encoded = issubclass(self.dset.src.bucket, EncodedSortedBucket)
+        key = _encoded_key if encoded else self.dset.src.sort_key
+
+        bucket = (SortedBucket if encoded else self.dset.src.bucket)(
             (self.dset.id, self.idx),
-            self.dset.src.key, None,
+            key, None,
             self.dset.src.block_size_mb,
             self.dset.src.memory_container,
             self.dset.src.disk_container
         )
 
         def spill(nbytes):
-            spilled = bucket.serialize(True)
+            data_file = DataFile(self.id + ('spill',))
+            spilled = bucket.serialize(True, data_file)
+            data_file.close()
             logger.debug('spilled %.2f mb', spilled / 1024 / 1024)
             return spilled
 
@@ -659,25 +2125,151 @@ class ShuffleReadingPartition(Partition):
             logger.info('sorting %.1f mb', bytes_received / 1024 / 1024)
 
         if not bucket.batches:
-            return iter(bucket)
+            merged = iter(bucket)
+        else:
+            merged = self._external_merge(bucket, lambda streams: merge_sorted(*streams, key=key))
+
+        return _decode_elements(merged) if encoded else merged
+
+
+    def merge_combined(self, blocks):
+        merge_combs = self.dset.src.comb[2]
+
+        bucket = HashOrderedCombiningBucket(
+            (self.dset.id, self.idx),
+            self.dset.src.sort_key, (identity, merge_combs, merge_combs),
+            self.dset.src.block_size_mb,
+            self.dset.src.memory_container,
+            self.dset.src.disk_container
+        )
+
+        def spill(nbytes):
+            data_file = DataFile(self.id + ('spill',))
+            spilled = bucket.serialize(True, data_file)
+            data_file.close()
+            logger.debug('spilled %.2f mb', spilled / 1024 / 1024)
+            return spilled
+
+        bytes_received = 0
+        with self.dset.ctx.node.memory.async_release_helper(self.id, spill, priority=1) as memcheck:
+            for block in blocks:
+                bytes_received += block.size
+                data = block.read()
+                bucket.extend(data)
+                memcheck()
+
+                logger.debug('received block of %.2f mb, %r items',
+                             block.size / 1024 / 1024, len(data))
+
+            logger.info('combined %.1f mb', bytes_received / 1024 / 1024)
+
+        if not bucket.batches:
+            return iter(bucket.items())
         else:
-            streams = [bucket]
-            for batch in bucket.batches:
-                streams.append(chain.from_iterable(block.read() for block in reversed(batch)))
-            return merge_sorted(*streams, key=self.dset.src.key)
+            # the spilled batches and the bucket itself are ordered by the hash of the keys,
+            # merge them by this hash and combine the (few) keys which share a hash
+            def merge(streams):
+                return self._merge_hash_ordered(merge_sorted(*streams, key=_hash_key), merge_combs)
+            return self._external_merge(bucket, merge)
+
+
+    def _external_merge(self, bucket, merge):
+        '''
+        Merge the elements in bucket with the batches it spilled (the runs) with at most
+        bndl.compute.shuffle.merge_fan_in runs at a time. If there are more runs, the smallest
+        runs are merged into a new run on disk first, in as many passes as required. While
+        merging, the next block of each run is read ahead.
+
+        :param bucket: Bucket
+            The bucket with spilled batches.
+        :param merge: callable(sequence[iterable]): iterable
+            Merges sorted streams of elements into one sorted stream.
+        '''
+        fan_in = max(2, self.dset.ctx.conf['bndl.compute.shuffle.merge_fan_in'])
+        # the blocks in the batches are in reverse order (see Bucket.serialize)
+        runs = [batch[::-1] for batch in bucket.batches]
+        bucket.batches = []
+
+        def run_size(run):
+            return sum(block.size for block in run)
+
+        executor = ThreadPoolExecutor(fan_in)
+
+        try:
+            # leave room for the elements in bucket itself in the last pass
+            max_runs = fan_in - 1
+            if len(runs) > max_runs:
+                # merge just enough runs in the first pass so that the next passes have the full fan in
+                count = (len(runs) - max_runs - 1) % (fan_in - 1) + 2
+                element_size = bucket.element_size
+                merge_no = 0
+                while len(runs) > max_runs:
+                    runs.sort(key=run_size)
+                    merging, runs = runs[:count], runs[count:]
+                    streams = [self._read_run(run, executor) for run in merging]
+                    runs.append(self._write_run(merge(streams), element_size, merge_no))
+                    merge_no += 1
+                    count = fan_in
+                logger.debug('merged runs in %s passes', merge_no)
+
+            streams = [bucket] + [self._read_run(run, executor) for run in runs]
+            yield from merge(streams)
+        finally:
+            executor.shutdown(wait=False)
+
+
+    def _read_run(self, run, executor):
+        # read ahead one block
+        reads = prefetch(lambda block: executor.submit(block.read), run)
+        for read in reads:
+            yield from read.result()
+
+
+    def _write_run(self, elements, element_size, merge_no):
+        data_file = DataFile(self.id + ('merge',))
+        Container = data_file.segment(self.dset.src.disk_container)
+        block_size_recs = ceil(self.dset.src.block_size_mb * 1024 * 1024 / element_size)
+        elements = iter(elements)
+        run = []
+        while True:
+            block = list(islice(elements, block_size_recs))
+            if not block:
+                break
+            container = Container(self.id + ('merge', '%r.%r' % (merge_no, len(run))))
+            container.write(block)
+            run.append(container)
+        data_file.close()
+        return run
+
+
+    def _merge_hash_ordered(self, elements, merge_combs):
+        for _, group in groupby(elements, key=_hash_key):
+            merged = {}
+            for key, combined in group:
+                try:
+                    merged[key] = merge_combs(merged[key], combined)
+                except KeyError:
+                    merged[key] = combined
+            yield from merged.items()
 
 
     def _compute(self):
         sort = self.dset.sorted or self.dset.src.bucket.sorted
+        combine = self.dset.src.bucket.combining
 
         logger.info('starting %s shuffle read of partition %r',
-                    'sorted' if sort else 'unsorted', self.id)
+                    'sorted' if sort else 'combining' if combine else 'unsorted', self.id)
 
         # create a stream of blocks
-        blocks = self.blocks()
+        if self.dset.src.pipelined:
+            blocks = self.pipelined_blocks()
+        else:
+            blocks = self.blocks()
 
         if sort:
             return self.merge_sorted(blocks)
+        elif combine:
+            return self.merge_combined(blocks)
         else:
             return chain.from_iterable(block.read() for block in blocks)
 
@@ -694,19 +2286,19 @@ class ShuffleManager(object):
         # output buckets structured as:
         # - dict keyed by: shuffle write data set id
         # - dict keyed by: source partition index
-        # - dict keyed by: destination partition index (in shuffle read data set)
+        # - MapOutput indexed by: destination partition index (in shuffle read data set)
         # - list of batches
         # - list of blocks
         self.buckets = {}
 
 
-    def set_buckets(self, part, buckets):
+    def set_buckets(self, part, output):
         '''
         Set the buckets for the data set of the given partition (after shuffle write).
         :param part: The partition of the source (shuffle writing) data set.
-        :param buckets: The buckets computed for the partition.
+        :param output: The MapOutput with the buckets computed for the partition.
         '''
-        self.buckets.setdefault(part.dset.id, {})[part.idx] = [bucket.batches for bucket in buckets]
+        self.buckets.setdefault(part.dset.id, {})[part.idx] = output
 
 
     def _buckets_for_dset(self, src_dset_id):
@@ -719,26 +2311,123 @@ class ShuffleManager(object):
     @rmi.direct
     def get_bucket_sizes(self, src, src_dset_id, dest_part_idx):
         '''
-        Return the sizes and coordinates of the buckets for the destination partition.
+        Return the sizes and coordinates of the buckets for the destination partition. For each
+        source partition a list of (block count, size in bytes) tuples is given, one for every
+        batch in the bucket.
 
         :param src: The (rmi) peer node requesting the finalization.
         :param dset_id: The id of the source data set.
         :param dest_part_idx: The index of the destination partition.
         '''
+        return self.get_buckets_sizes(src, src_dset_id, [dest_part_idx])[0]
+
+
+    @rmi.direct
+    def get_buckets_sizes(self, src, src_dset_id, dest_part_idxs):
+        '''
+        Return the sizes and coordinates of the buckets (see get_bucket_sizes) for each of the
+        destination partitions.
+
+        :param src: The (rmi) peer node requesting the sizes.
+        :param dset_id: The id of the source data set.
+        :param dest_part_idxs: The indices of the destination partitions.
+        '''
         try:
             dset_buckets = self._buckets_for_dset(src_dset_id)
         except KeyError:
-            return []
+            return [[] for _ in dest_part_idxs]
         else:
-            sizes = []
+            sizes = [[] for _ in dest_part_idxs]
             for src_part_idx, buckets in dset_buckets.items():
-                bucket = buckets[dest_part_idx]
-                bucket_sizes = [[block.size for block in batch]
-                                for batch in bucket]
-                sizes.append((src_part_idx, bucket_sizes))
+                for dest_sizes, dest_part_idx in zip(sizes, dest_part_idxs):
+                    bucket = buckets[dest_part_idx]
+                    bucket_sizes = [(len(batch), sum(block.size for block in batch))
+                                    for batch in bucket]
+                    dest_sizes.append((src_part_idx, bucket_sizes))
             return sizes
 
 
+    @rmi.direct
+    def get_output_sizes(self, src, src_dset_id):
+        '''
+        Return the size (in bytes) of the buckets for each destination partition per source
+        partition as a dict of source partition index to a list of sizes.
+
+        :param src: The (rmi) peer node requesting the sizes.
+        :param dset_id: The id of the source data set.
+        '''
+        try:
+            dset_buckets = self._buckets_for_dset(src_dset_id)
+        except KeyError:
+            return {}
+        else:
+            return {src_part_idx: output.sizes()
+                    for src_part_idx, output in dset_buckets.items()}
+
+
+    @rmi.direct
+    def get_output_samples(self, src, src_dset_id):
+        '''
+        Return the samples of partition keys of the sorted runs written for the data set (see
+        ShuffleWritingDataset.learns_boundaries).
+
+        :param src: The (rmi) peer node requesting the samples.
+        :param src_dset_id: The id of the source data set.
+        '''
+        return [key
+                for output in self.buckets.get(src_dset_id, {}).values()
+                if output.samples
+                for key in output.samples]
+
+
+    def partition_runs(self, src, src_dset_id, boundaries):
+        '''
+        Partition the runs written for the data set with the learned boundaries into the buckets
+        for the shuffle read (see ShuffleWritingDataset.learns_boundaries). Runs are partitioned
+        once, by the first request which finds them. Runs which are being partitioned for another
+        request are waited for.
+
+        :param src: The (rmi) peer node requesting the partitioning.
+        :param src_dset_id: The id of the source data set.
+        :param boundaries: The boundaries for the RangePartitioner of the data set.
+        '''
+        outputs = self.buckets.get(src_dset_id, {})
+        pending = []
+        for src_part_idx, output in list(outputs.items()):
+            with output._lock:
+                part, output.part = output.part, None
+                if part is not None:
+                    output.partitioned = Future()
+                partitioned = output.partitioned
+            if part is None:
+                if partitioned is not None:
+                    pending.append(partitioned)
+                continue
+            try:
+                part.dset.partitioner.set_boundaries(boundaries)
+                outputs[src_part_idx] = part._partition_run(output)
+            except Exception as exc:
+                # allow the run to be partitioned again
+                with output._lock:
+                    output.part = part
+                    output.partitioned = None
+                partitioned.set_exception(exc)
+                raise
+            else:
+                partitioned.set_result(None)
+        for partitioned in pending:
+            partitioned.result()
+
+
+    @rmi.direct
+    def get_io_stats(self, src):
+        '''
+        Return the I/O statistics per work directory of this worker (see
+        bndl.compute.storage.work_dir_stats).
+        '''
+        return work_dir_stats()
+
+
     @rmi.direct
     def get_bucket_block(self, src, src_dset_id, src_part_idx, dest_part_idx, batch_idx, block_idx):
         '''
@@ -794,6 +2483,27 @@ class ShuffleManager(object):
                 for coordinate in coordinates]
 
 
+    def get_local_bucket_blocks(self, src, coordinates):
+        '''
+        Retrieve blocks for a peer on the same host. The map outputs of the blocks are moved to
+        disk (if not already) so that the blocks are sent as a path and offset into a file in the
+        work dir (see bndl.net.sendfile.file_attachment) which the peer reads itself. Note that
+        this writes map outputs which are in memory to disk, the write is traded for not sending
+        the data over the (loopback) network.
+
+        :param src: requesting peer
+        :param coordinates: sequence of (src_dset_id, src_part_idx, dest_part_idx, batch_idx, block_idx) tuples
+        '''
+        outputs = set((src_dset_id, src_part_idx)
+                      for src_dset_id, src_part_idx, *_ in coordinates)
+        for src_dset_id, src_part_idx in outputs:
+            output = self.buckets.get(src_dset_id, {}).get(src_part_idx)
+            if output is not None:
+                output.to_disk()
+                self.worker.memory.remove_releasable(output.id)
+        return self.get_bucket_blocks(src, coordinates)
+
+
     def clear_bucket(self, src, dset_id):
         '''
         Clear all the buckets for a dataset
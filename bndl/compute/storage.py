@@ -10,7 +10,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from itertools import chain
+from contextlib import contextmanager
+from itertools import chain, count, islice
 from os.path import getsize
 import atexit
 import importlib
@@ -21,14 +22,16 @@ import os
 import pickle
 import shutil
 import struct
+import sys
 import tempfile
+import threading
 
 from cytoolz.functoolz import compose
 
 from bndl.compute.blocks import Block
 from bndl.net.sendfile import file_attachment, is_remote
 from bndl.net.serialize import attach, attachment
-from bndl.util.conf import String
+from bndl.util.conf import CSV, Enum
 from bndl.util.funcs import noop
 import bndl
 import lz4
@@ -41,8 +44,13 @@ _LENGTH_FIELD_FMT = 'I'
 _LENGTH_FIELD_SIZE = struct.calcsize(_LENGTH_FIELD_FMT)
 
 
-work_dir = String(None, desc='The working directory for bndl.compute (used for caching, shuffle '
-                             'data, etc.).')
+work_dir = CSV(None, desc='The working directory for bndl.compute (used for caching, shuffle data, '
+                          'etc.). Multiple (comma separated) directories can be given, e.g. one on '
+                          'each disk, files are spread over these directories.')
+work_dir_selection = Enum('round_robin', choices=('round_robin', 'least_loaded'),
+                          desc='How files are spread over the work directories: round_robin or '
+                               'least_loaded (the directory with the fewest writes in progress and '
+                               'the most free space).')
 
 
 def _text_dumps(lines):
@@ -219,7 +227,10 @@ class SerializedInMemory(SerializedContainer, InMemory, Block):
     def size(self):
         return len(self.data) if self.data else 0
 
-    def to_disk(self):
+    def to_disk(self, data_file=None):
+        if data_file is not None:
+            self.to_segment(data_file)
+            return
         on_disk = OnDisk(self.id, self.provider)
         clear_old = on_disk.clear
         on_disk.clear = noop
@@ -230,59 +241,180 @@ class SerializedInMemory(SerializedContainer, InMemory, Block):
         self.__dict__.pop('data')
 
 
+    def to_segment(self, data_file):
+        '''
+        Move the data of this container into a segment of data_file.
+        '''
+        data = self.__dict__.pop('data')
+        offset = data_file.append(data)
+        self.__class__ = FileSegment
+        FileSegment._init(self, data_file, offset, len(data))
+
+
+
+class WorkDir(object):
+    '''
+    A (temporary) working directory for bndl.compute with I/O statistics.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.pending = 0
+        self.reads = 0
+        self.writes = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+
+    @contextmanager
+    def io(self, write, nbytes):
+        '''
+        Track a read or write of nbytes while it is in progress and once complete.
+        '''
+        with self._lock:
+            self.pending += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.pending -= 1
+                if write:
+                    self.writes += 1
+                    self.bytes_written += nbytes
+                else:
+                    self.reads += 1
+                    self.bytes_read += nbytes
+
+
+    @property
+    def free(self):
+        return shutil.disk_usage(self.path).free
 
-def _get_work_dir():
-    work_dir = os.environ.get('TMPDIR') or \
-               os.environ.get('TEMP') or \
-               os.environ.get('TMP') or \
-               bndl.conf.get('bndl.compute.storage.work_dir') or \
-               tempfile.gettempdir()
-    if os.path.exists('/proc/mounts'):
-        with open('/proc/mounts') as mounts:
-            for mount in mounts:
-                mount = mount.split()
-                if work_dir.startswith(mount[1]) and mount[0] == 'tmpfs':
-                    if os.path.exists('/var/tmp'):
-                        work_dir = '/var/tmp'
-    return tempfile.mkdtemp('', 'bndl-%s-' % str(os.getpid()), work_dir)
 
+    def stats(self):
+        return dict(
+            pending=self.pending,
+            reads=self.reads,
+            writes=self.writes,
+            bytes_read=self.bytes_read,
+            bytes_written=self.bytes_written,
+            free=self.free,
+        )
+
+
+    def __repr__(self):
+        return '<WorkDir %s>' % self.path
+
+
+
+def _get_work_dirs():
+    roots = os.environ.get('TMPDIR') or \
+            os.environ.get('TEMP') or \
+            os.environ.get('TMP') or \
+            bndl.conf.get('bndl.compute.storage.work_dir') or \
+            tempfile.gettempdir()
+    if isinstance(roots, str):
+        roots = [roots]
+    mounts = []
+    if os.path.exists('/proc/mounts'):
+        with open('/proc/mounts') as f:
+            mounts = [mount.split() for mount in f]
+    work_dirs = []
+    for root in roots:
+        for mount in mounts:
+            if root.startswith(mount[1]) and mount[0] == 'tmpfs':
+                if os.path.exists('/var/tmp'):
+                    root = '/var/tmp'
+        path = tempfile.mkdtemp('', 'bndl-%s-' % str(os.getpid()), root)
+        work_dirs.append(WorkDir(path))
+    return work_dirs
+
+
+_work_dirs = None
+_work_dirs_lock = threading.Lock()
+_round_robin = count()
+_external_ids = count()
+
+
+def get_work_dirs():
+    '''
+    The working directories (WorkDir objects) of this process.
+    '''
+    global _work_dirs
+    if _work_dirs is None:
+        with _work_dirs_lock:
+            if _work_dirs is None:
+                _work_dirs = _get_work_dirs()
+    return _work_dirs
 
-_work_dir = None
 
 def get_work_dir():
-    global _work_dir
-    if _work_dir is None:
-        _work_dir = _get_work_dir()
-    return _work_dir
+    '''
+    The path of the (first) working directory of this process.
+    '''
+    return get_work_dirs()[0].path
+
+
+def select_work_dir():
+    '''
+    Select the working directory for a new file according to
+    bndl.compute.storage.work_dir_selection.
+    '''
+    work_dirs = get_work_dirs()
+    if len(work_dirs) == 1:
+        return work_dirs[0]
+    elif bndl.conf['bndl.compute.storage.work_dir_selection'] == 'least_loaded':
+        return min(work_dirs, key=lambda work_dir: (work_dir.pending, -work_dir.free))
+    else:
+        return work_dirs[next(_round_robin) % len(work_dirs)]
+
+
+def work_dir_stats():
+    '''
+    I/O statistics per working directory (path): the number of reads and writes in progress
+    (pending), completed reads and writes, bytes read and written and free disk space.
+    '''
+    return {work_dir.path: work_dir.stats() for work_dir in get_work_dirs()}
 
 
 @atexit.register
 def clean_work_dir():
-    if _work_dir:
-        try:
-            shutil.rmtree(_work_dir)
-        except (FileNotFoundError, OSError):
-            pass
+    if _work_dirs:
+        for work_dir in _work_dirs:
+            try:
+                shutil.rmtree(work_dir.path)
+            except (FileNotFoundError, OSError):
+                pass
 
 
 
 class OnDisk(SerializedContainer):
+    work_dir = None
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         * dirpath, filename = self.id
-        dirpath = os.path.join(get_work_dir(), *map(str, dirpath))
+        self.work_dir = select_work_dir()
+        dirpath = os.path.join(self.work_dir.path, *map(str, dirpath))
         os.makedirs(dirpath, exist_ok=True)
         self.filepath = os.path.join(dirpath, str(filename))
 
 
     def _read(self):
         with open(self.filepath, 'rb') as f:
-            return f.read()
+            if self.work_dir is None:
+                return f.read()
+            with self.work_dir.io(False, os.fstat(f.fileno()).st_size):
+                return f.read()
 
 
     def _write(self, data):
         with open(self.filepath, 'wb') as f:
-            f.write(data)
+            if self.work_dir is None:
+                f.write(data)
+            else:
+                with self.work_dir.io(True, len(data)):
+                    f.write(data)
 
 
     def clear(self):
@@ -315,3 +447,253 @@ class OnDisk(SerializedContainer):
         if is_remote(data):
             self.data = data[1:]
             self.__class__ = SerializedInMemory
+
+
+
+class DataFile(object):
+    '''
+    A file in the work dir to which the data of multiple containers is appended, e.g. all blocks
+    spilled / serialized by a shuffle write task. The containers are :class:`FileSegment`
+    instances which keep a reference to the data file, the file is removed when the data file
+    object is garbage collected (i.e. when all segments are cleared).
+    '''
+    def __init__(self, file_id):
+        * dirpath, filename = file_id
+        self.work_dir = select_work_dir()
+        dirpath = os.path.join(self.work_dir.path, *map(str, dirpath))
+        os.makedirs(dirpath, exist_ok=True)
+        # use a unique file name, e.g. a re-executed task may create a data file with the same
+        # id while the data file of the previous execution hasn't been removed yet
+        fd, self.filepath = tempfile.mkstemp(prefix='%s-' % filename, dir=dirpath)
+        os.close(fd)
+        self.size = 0
+        self._file = None
+
+
+    def segment(self, provider):
+        '''
+        Create a container factory for segments of this file. The segments are written to the
+        file when their data is written and serialized with provider.
+        '''
+        def create(container_id):
+            return FileSegment(container_id, provider, self)
+        return create
+
+
+    def append(self, data):
+        '''
+        Append data to the file and return the offset at which it was written.
+        '''
+        if self._file is None:
+            self._file = open(self.filepath, 'ab')
+        offset = self.size
+        with self.work_dir.io(True, len(data)):
+            self._file.write(data)
+        self.size += len(data)
+        return offset
+
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+
+    def close(self):
+        '''
+        Close the file for appending (but keep it on disk).
+        '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+    def __del__(self):
+        self.close()
+        try:
+            os.remove(self.filepath)
+        except (AttributeError, FileNotFoundError):
+            pass
+        except Exception:
+            logger.exception('Unable to remove data file %s', self.filepath)
+
+
+
+class FileSegment(SerializedContainer):
+    '''
+    A container which stores its data as a (offset, length) segment in a :class:`DataFile`.
+    '''
+    work_dir = None
+
+    def __init__(self, container_id, provider, data_file):
+        super().__init__(container_id, provider)
+        self._init(data_file, None, 0)
+
+
+    def _init(self, data_file, offset, length):
+        self.data_file = data_file
+        self.work_dir = data_file.work_dir
+        self.filepath = data_file.filepath
+        self.offset = offset
+        self.length = length
+
+
+    def _read(self):
+        if self.data_file is not None:
+            # ensure written data is visible for reading
+            self.data_file.flush()
+        with open(self.filepath, 'rb') as f:
+            if self.work_dir is None:
+                return os.pread(f.fileno(), self.length, self.offset)
+            with self.work_dir.io(False, self.length):
+                return os.pread(f.fileno(), self.length, self.offset)
+
+
+    def _write(self, data):
+        self.offset = self.data_file.append(data)
+        self.length = len(data)
+
+
+    def clear(self):
+        # the data file is removed once no segments refer to it anymore
+        self.data_file = None
+
+
+    @property
+    def size(self):
+        return self.length
+
+
+    def __getstate__(self):
+        key = ('%s:%s' % (self.filepath, self.offset)).encode('utf-8')
+        attach(key, file_attachment(self.filepath, self.offset, self.length)[1])
+        return {
+            'id': self.id,
+            'filepath': self.filepath,
+            'offset': self.offset,
+            'length': self.length,
+            'provider': self.provider,
+            'data_file': None,
+        }
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        data = attachment(('%s:%s' % (self.filepath, self.offset)).encode('utf-8'))
+        if is_remote(data):
+            self.data = data[1:]
+            self.__class__ = SerializedInMemory
+
+
+
+class ExternalList(object):
+    '''
+    An append only list which keeps at most max_size elements in memory. Beyond that the elements
+    are spilled in chunks to a data file in the work dir. The list can be iterated over multiple
+    times.
+
+    If a memory manager (LocalMemoryManager) is given, the elements in memory are registered
+    with it (with an estimate of their size) so that they are spilled when memory is needed.
+    '''
+    def __init__(self, max_size, file_id=('external',), memory=None):
+        self.max_size = max(1, max_size)
+        self.file_id = file_id
+        self.id = file_id + (next(_external_ids),)
+        self.memory = memory
+        self.elements = []
+        self.chunks = []
+        self.length = 0
+        self._data_file = None
+        self._element_size = None
+        self._registered = 0
+        self._lock = threading.Lock()
+
+
+    def append(self, element):
+        with self._lock:
+            self.elements.append(element)
+            self.length += 1
+            in_memory = len(self.elements)
+        if in_memory >= self.max_size:
+            self.spill()
+        elif self.memory is not None and in_memory >= max(1000, self._registered * 2):
+            self._register()
+
+
+    def extend(self, elements):
+        # add the elements in chunks so that the lock is taken once per chunk
+        elements = iter(elements)
+        while True:
+            chunk = list(islice(elements, max(1, min(1000, self.max_size - len(self.elements)))))
+            if not chunk:
+                break
+            with self._lock:
+                self.elements.extend(chunk)
+                self.length += len(chunk)
+                in_memory = len(self.elements)
+            if in_memory >= self.max_size:
+                self.spill()
+            elif self.memory is not None and in_memory >= max(1000, self._registered * 2):
+                self._register()
+
+
+    def _register(self):
+        with self._lock:
+            in_memory = len(self.elements)
+            if self._element_size is None:
+                # estimate the footprint in memory from the size of the element objects (and a
+                # pointer in the list) or the pickled size for nested elements
+                sample = self.elements[:100]
+                shallow = sum(map(sys.getsizeof, sample)) // len(sample) + 8
+                pickled = len(pickle.dumps(sample)) // len(sample)
+                self._element_size = max(shallow, pickled)
+        self.memory.remove_releasable(self.id)
+        self.memory.add_releasable(self._release, self.id, 1, in_memory * self._element_size)
+        self._registered = in_memory
+
+
+    def _release(self):
+        spilled = self.spill()
+        logger.debug('spilled %.2f mb of external list %s', spilled / 1024 / 1024, self.id)
+        return spilled
+
+
+    def spill(self):
+        '''
+        Write the elements in memory to disk.
+        '''
+        with self._lock:
+            if not self.elements:
+                return 0
+            if self._data_file is None:
+                self._data_file = DataFile(self.file_id)
+            provider = StorageContainerFactory('disk', 'pickle', 'lz4')
+            chunk = self._data_file.segment(provider)(self.id + (len(self.chunks),))
+            chunk.write(self.elements)
+            self.chunks.append(chunk)
+            self.elements = []
+        if self.memory is not None and self._registered:
+            self.memory.remove_releasable(self.id)
+            self._registered = 0
+        return chunk.size
+
+
+    @property
+    def spilled(self):
+        return bool(self.chunks)
+
+
+    def __len__(self):
+        return self.length
+
+
+    def __iter__(self):
+        with self._lock:
+            chunks = self.chunks[:]
+            elements = self.elements[:]
+        for chunk in chunks:
+            yield from chunk.read()
+        yield from elements
+
+
+    def __reduce__(self):
+        return list, (list(self),)
@@ -34,3 +34,12 @@ class ReduceByKeyTest(DatasetTest):
         avg_by_key = sum_count.starmap(lambda key, value: (key, value[0] / value[1]))
 
         self.assertDictEqual(avg_by_key.collect_as_map(), expected)
+
+
+    def test_hash_vs_sort(self):
+        pairs = self.ctx.range(10000, pcount=4).map(lambda i: (i % 97, i))
+        args = (lambda value: [value], lambda x, value: x + [value], lambda x, y: x + y)
+        hashed = pairs.combine_by_key(*args, pcount=3).map_values(sorted).collect_as_map()
+        sorted_ = pairs.combine_by_key(*args, pcount=3, sort=True).map_values(sorted).collect_as_map()
+        self.assertEqual(len(hashed), 97)
+        self.assertDictEqual(hashed, sorted_)
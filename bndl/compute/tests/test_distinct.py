@@ -10,8 +10,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from unittest import mock
+
+from bndl.compute import storage
+from bndl.compute.dataset import _hash_distinct
 from bndl.compute.tests import DatasetTest
 from bndl.util.funcs import iseven, isodd
+from bndl.util.hash import portable_hash
 
 
 class TestDistinct(DatasetTest):
@@ -34,3 +39,24 @@ class TestDistinct(DatasetTest):
         remainders.sort(key=iseven)
         self.assertTrue(isodd(remainders[0]))
         self.assertTrue(iseven(remainders[1]))
+
+    def test_distinct_spill(self):
+        dset = self.ctx.range(10000, pcount=4).map(lambda i: i % 3000)
+        self.ctx.conf['bndl.compute.dataset.distinct_buffer'] = 100
+        try:
+            self.assertEqual(sorted(dset.distinct(3).collect()), list(range(3000)))
+            self.assertEqual(len(dset.distinct(3, key=lambda i: i % 500).collect()), 500)
+            self.assertEqual(dset.count_distinct(), 3000)
+        finally:
+            self.ctx.conf['bndl.compute.dataset.distinct_buffer'] = 1000000
+
+    def test_distinct_spill_partitioned(self):
+        # the elements of a partition of a shuffle into 256 partitions share the low 8 bits of
+        # their hash, spilling must split them nonetheless
+        elements = [i for i in range(1000 * 1000) if portable_hash(i) % 256 == 0][:1000]
+        with mock.patch.object(storage, 'ExternalList', wraps=storage.ExternalList) as lists:
+            distinct = list(_hash_distinct(elements * 2, None, 100, ('test',), None))
+        self.assertEqual(sorted(e for part in distinct for e in part), sorted(elements))
+        # split into 16 parts once
+        self.assertEqual(lists.call_count, 16)
+        self.assertEqual(len(distinct), 16)
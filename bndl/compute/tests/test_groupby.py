@@ -25,3 +25,42 @@ class GroupbyTest(DatasetTest):
             False: list(range(1, 100, 2)),
             True: list(range(0, 100, 2)),
         })
+
+    def test_group_by_key_sort_values(self):
+        dset = self.ctx.range(1000, pcount=4).map(lambda i: (i % 10, (i * 7919) % 1000))
+        groups = dset.group_by_key(pcount=3, sort_values=True).collect_as_map()
+        self.assertEqual(groups, dset.group_by_key().map_values(sorted).collect_as_map())
+        groups = dset.group_by_key(pcount=3, sort_values=lambda v: -v).collect_as_map()
+        self.assertEqual(groups, dset.group_by_key().map_values(lambda vs: sorted(vs, reverse=True))
+                                     .collect_as_map())
+
+    def test_partition_and_sort_key(self):
+        dset = self.ctx.range(1000, pcount=4).map(lambda i: (i % 10, -i))
+        parts = dset.shuffle(pcount=3, partition_key=0, sort_key=1).collect(parts=True)
+        for part in parts:
+            # partitioned on the first field and sorted on the second
+            self.assertEqual(part, sorted(part, key=lambda e: e[1]))
+        keys = [set(e[0] for e in part) for part in parts]
+        self.assertEqual(sum(map(len, keys)), 10)
+        self.assertEqual(sorted(e for part in parts for e in part), sorted(dset.collect()))
+
+    def test_group_by_key_spill(self):
+        dset = self.ctx.range(1000, pcount=4).map(lambda i: (i % 3, i))
+        self.ctx.conf['bndl.compute.dataset.group_buffer'] = 100
+        try:
+            groups = dset.group_by_key().map_values(lambda values: (type(values).__name__,
+                                                                    len(values),
+                                                                    sum(values), sum(values)))
+            for key, (group_type, size, total, total_again) in groups.collect():
+                self.assertEqual(group_type, 'ExternalList')
+                self.assertEqual(size, len(range(key, 1000, 3)))
+                self.assertEqual(total, sum(range(key, 1000, 3)))
+                self.assertEqual(total_again, total)
+            self.assertEqual(dset.group_by_key().map_values(sorted).collect_as_map(),
+                             {key: list(range(key, 1000, 3)) for key in range(3)})
+            # groups within the buffer are plain lists
+            small = self.ctx.range(1000, pcount=4).map(lambda i: (i % 10, i)).group_by_key()
+            self.assertEqual(set(small.map_values(lambda values: type(values).__name__)
+                                      .values().collect()), {'list'})
+        finally:
+            self.ctx.conf['bndl.compute.dataset.group_buffer'] = 1000000
@@ -12,6 +12,7 @@
 
 from itertools import product, chain, groupby
 
+from bndl.compute.shuffle import ShuffleReadingDataset
 from bndl.compute.tests import DatasetTest
 from bndl.util.funcs import iseven, isodd
 from operator import itemgetter
@@ -84,3 +85,121 @@ class JoinTest(DatasetTest):
                             c.values().collect()
                         ))
         self.assertTrue(all(abc.starmap(lambda key, groups: list(str(v % 4) == key for v in chain(*groups))).flatmap().collect()))
+
+
+    def test_skewed_join(self):
+        # key 0 is hot in a
+        a = self.ctx.range(1000, pcount=4).map(lambda i: (0 if i % 10 else i % 7, i)).cache()
+        b = self.ctx.range(100, pcount=2).map(lambda i: (i % 7, i)).cache()
+
+        def pairs(joined):
+            return sorted(joined.values().flatmap().collect())
+
+        expected = pairs(a.join(b, pcount=6))
+        skewed = a.join(b, pcount=6, skew=True)
+        self.assertEqual(pairs(skewed), expected)
+        # the hot key is spread over multiple partitions
+        self.assertGreater(skewed.keys().filter(lambda k: k == 0).count(), 1)
+        self.assertEqual(skewed.keys().collect_as_set(), a.join(b).keys().collect_as_set())
+
+
+    def test_broadcast_join(self):
+        a = self.ctx.range(1000, pcount=4).map(lambda i: (i % 7, i))
+        b = self.ctx.range(100, pcount=2).map(lambda i: (i % 5, i))
+
+        def pairs(joined):
+            return sorted(joined.values().flatmap().collect())
+
+        expected = pairs(a.join(b))
+        self.assertEqual(pairs(a.join(b, strategy='broadcast')), expected)
+        self.assertEqual(pairs(a.join(b, strategy='auto')), expected)
+        self.assertEqual(pairs(b.join(a, strategy='broadcast')), pairs(b.join(a)))
+        self.ctx.conf['bndl.compute.dataset.broadcast_join_threshold'] = 100
+        try:
+            # a is too large to broadcast, but the left side is broadcast when swapped
+            self.assertEqual(pairs(b.join(a, strategy='auto')), pairs(b.join(a)))
+        finally:
+            self.ctx.conf['bndl.compute.dataset.broadcast_join_threshold'] = 10000
+        with self.assertRaises(ValueError):
+            a.join(b, strategy='hash')
+        with self.assertRaises(ValueError):
+            a.join(b, strategy='broadcast', pcount=3)
+        with self.assertRaises(ValueError):
+            a.join(b, strategy='broadcast', skew=True)
+
+        # the pairs are produced per element of the partitions which aren't broadcast
+        joined = a.join(b, strategy='broadcast')
+        self.assertEqual(joined.count(), a.filter(lambda kv: kv[0] < 5).count())
+
+
+    def test_copartitioned_join(self):
+        a = self.ctx.range(100).map(lambda i: (i % 10, i)).aggregate_by_key(sum, pcount=4)
+        b = self.ctx.range(100).map(lambda i: (i % 10, -i)).group_by_key(pcount=4).map_values(len)
+        self.assertEqual(a.partitioning, b.partitioning)
+
+        def shuffles(dset):
+            srcs = dset.src if isinstance(dset.src, (list, tuple)) else [dset.src] if dset.src else []
+            return isinstance(dset, ShuffleReadingDataset) + sum(map(shuffles, srcs))
+
+        ab = a.join(b)
+        self.assertEqual(shuffles(ab), 2)
+        self.assertEqual(ab.partitioning, a.partitioning)
+        shuffled = a.join(b, pcount=5)
+        self.assertEqual(shuffles(shuffled), 3)
+        self.assertEqual(sorted(ab.collect()), sorted(shuffled.collect()))
+        self.assertEqual(sorted(a.map_values(str).group_by_key().collect()),
+                         sorted(a.map_values(str).group_by_key(pcount=3).collect()))
+        self.assertEqual(shuffles(a.map_values(str).group_by_key()), 1)
+        self.assertEqual(shuffles(a.map(lambda kv: kv).group_by_key()), 2)
+
+
+    def test_merge_join(self):
+        a = self.ctx.range(1000, pcount=4).map(lambda i: (i % 7, i))
+        b = self.ctx.range(100, pcount=3).map(lambda i: (i % 5, i))
+
+        def pairs(joined):
+            return sorted(joined.values().flatmap().collect())
+
+        self.assertEqual(pairs(a.join(b, strategy='merge')), pairs(a.join(b)))
+        self.assertEqual(sorted((k, sorted(l), sorted(r))
+                                for k, (l, r) in a.cogroup(b, strategy='merge').collect()),
+                         sorted((k, sorted(l), sorted(r)) for k, (l, r) in a.cogroup(b).collect()))
+        with self.assertRaises(ValueError):
+            a.join(b, strategy='merge', skew=True)
+
+        # groups are spilled and the pairs are chunked beyond merge_buffer
+        self.ctx.conf['bndl.compute.dataset.merge_buffer'] = 10
+        try:
+            joined = a.join(b, strategy='merge', pcount=3)
+            self.assertEqual(pairs(joined), pairs(a.join(b)))
+            self.assertTrue(all(len(chunk) <= 10 for chunk in joined.values().collect()))
+
+            # both sides of a single key spill
+            c = self.ctx.range(1000, pcount=4).map(lambda i: (0, i))
+            d = self.ctx.range(50, pcount=3).map(lambda i: (0, -i))
+            group_types = c.cogroup(d, strategy='merge') \
+                           .map_values(lambda groups: [type(g).__name__ for g in groups]).collect()
+            self.assertEqual(group_types, [(0, ['ExternalList', 'ExternalList'])])
+            self.assertEqual(pairs(c.join(d, strategy='merge')),
+                             sorted((i, -j) for i in range(1000) for j in range(50)))
+        finally:
+            self.ctx.conf['bndl.compute.dataset.merge_buffer'] = 100000
+        with self.assertRaises(ValueError):
+            a.cogroup(b, strategy='hash')
+
+
+    def test_bloom_filter_join(self):
+        a = self.ctx.range(10000, pcount=4).map(lambda i: (i, i * 2))
+        b = self.ctx.range(0, 10000, 100, pcount=3).map(lambda i: (i, str(i)))
+
+        bloom = b.keys().bloom_filter(capacity=100)
+        self.assertTrue(all(k in bloom for k in range(0, 10000, 100)))
+        self.assertLess(sum(k in bloom for k in range(1, 10000, 100)), 10)
+
+        filtered = a._bloom_filtered(b, None)
+        self.assertLess(filtered.count(), 200)
+        self.assertEqual(sorted(a.join(b, bloom_filter=True).collect()),
+                         sorted(a.join(b).collect()))
+        self.assertEqual(sorted(a.join(b, bloom_filter=True, strategy='merge').values()
+                                 .flatmap().collect()),
+                         sorted(a.join(b).values().flatmap().collect()))
@@ -0,0 +1,38 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bndl.compute.tests import DatasetTest
+
+
+class SetOperationsTest(DatasetTest):
+    def setUp(self):
+        super().setUp()
+        self.a = self.ctx.range(100, pcount=3).map(lambda i: i % 50)
+        self.b = self.ctx.range(25, 75, pcount=2)
+
+    def test_subtract(self):
+        self.assertEqual(sorted(self.a.subtract(self.b).collect()),
+                         sorted(list(range(25)) * 2))
+        self.assertEqual(self.a.subtract(self.a).count(), 0)
+
+    def test_intersection(self):
+        self.assertEqual(sorted(self.a.intersection(self.b, pcount=4).collect()),
+                         list(range(25, 50)))
+        self.assertEqual(self.a.intersection(self.ctx.range(0)).count(), 0)
+
+    def test_by_key(self):
+        a = self.a.key_by(str)
+        b = self.b.map(lambda i: (str(i), None))
+        self.assertEqual(sorted(a.subtract_by_key(b).collect()),
+                         sorted((str(i), i) for i in range(25) for _ in range(2)))
+        self.assertEqual(sorted(a.intersect_by_key(b).collect()),
+                         sorted((str(i), i) for i in range(25, 50) for _ in range(2)))
@@ -11,6 +11,8 @@
 # limitations under the License.
 
 from collections import OrderedDict
+from concurrent.futures import Future
+from itertools import chain
 import itertools
 import logging
 import os
@@ -19,7 +21,10 @@ import threading
 import time
 
 from cytoolz.itertoolz import pluck
+import numpy as np
 
+from bndl.compute.shuffle import BlockFetcher, EncodedSortedBucket, ListBucket, RecordBucket, \
+    SpillWriter, encode_key, plan_partitions
 from bndl.compute.tests import DatasetTest
 from bndl.util.collection import flatten
 
@@ -55,6 +60,216 @@ class ShuffleTest(DatasetTest):
         self.assertEqual(parts[1], part1_data)
 
 
+    def test_pipelined(self):
+        dset = self.ctx.range(10 * 1000, pcount=self.worker_count * 4).map(lambda i: (i % 100, i))
+        expected = sorted(dset.aggregate_by_key(sum).collect())
+        self.assertEqual(sorted(dset.aggregate_by_key(sum, pipelined=True).collect()), expected)
+        self.assertEqual(sorted(dset.reduce_by_key(lambda a, b: a + b, pipelined=True).collect()), expected)
+        self.assertEqual(sorted(dset.shuffle(sort=False, pipelined=True).collect()),
+                         sorted(dset.collect()))
+
+
+    def test_adaptive(self):
+        dset = self.ctx.range(10 * 1000, pcount=self.worker_count * 2).map(lambda i: (i % 100, i))
+        expected = sorted(dset.aggregate_by_key(sum).collect())
+        adaptive = dset.aggregate_by_key(sum, pcount=50, adaptive=True).collect(parts=True)
+        self.assertEqual(sorted(chain.from_iterable(adaptive)), expected)
+        # all (small) partitions are coalesced
+        self.assertEqual(len(list(filter(None, adaptive))), 1)
+
+        # split an oversized partition over the others
+        self.ctx.conf['bndl.compute.shuffle.adaptive_target_mb'] = 0.01
+        try:
+            skewed = dset.shuffle(pcount=4, sort=False, adaptive=True,
+                                  partitioner=lambda e: 0 if e[0] < 90 else 1)
+            parts = skewed.collect(parts=True)
+            self.assertEqual(sorted(chain.from_iterable(parts)), sorted(dset.collect()))
+            self.assertGreater(len(list(filter(None, parts))), 2)
+        finally:
+            self.ctx.conf['bndl.compute.shuffle.adaptive_target_mb'] = 64
+
+
+    def test_keep_outputs(self):
+        computed = self.ctx.accumulator(0)
+
+        def count(i):
+            nonlocal computed
+            computed += 1
+            return (i % 100, i)
+
+        dset = self.ctx.range(1000, pcount=self.worker_count * 2).map(count)
+        aggregated = dset.aggregate_by_key(sum)
+        self.assertEqual(aggregated.count(), 100)
+        self.assertEqual(sorted(aggregated.map_values(lambda v: v * 2).collect()),
+                         sorted((k, v * 2) for k, v in aggregated.collect()))
+        self.assertEqual(computed.value, 1000)
+
+        # the outputs are cleared and computed again if not kept
+        self.ctx.conf['bndl.compute.shuffle.keep_outputs'] = False
+        try:
+            aggregated = dset.aggregate_by_key(sum)
+            aggregated.count()
+            aggregated.count()
+            self.assertEqual(computed.value, 3000)
+        finally:
+            self.ctx.conf['bndl.compute.shuffle.keep_outputs'] = True
+
+
+    def test_merge_fan_in(self):
+        self.ctx.conf['bndl.compute.shuffle.merge_fan_in'] = 3
+        try:
+            size = 1000 * 1000
+            dset = self.ctx.range(size, pcount=self.worker_count * 2)
+            self.assertEqual(dset.map(lambda i: -i).sort(pcount=2).collect(),
+                             list(range(-size + 1, 1)))
+            counts = dset.map(lambda i: (i % 1000, 1)).reduce_by_key(lambda a, b: a + b)
+            self.assertEqual(sorted(counts.collect()), [(i, 1000) for i in range(1000)])
+        finally:
+            self.ctx.conf['bndl.compute.shuffle.merge_fan_in'] = 64
+
+
+    def test_block_fetcher(self):
+        issued = []
+        def get_blocks(source):
+            def get(coordinates):
+                issued.append(source)
+                future = Future()
+                future.set_result([(source, coordinates)])
+                return future
+            return get
+
+        sources = [(source, get_blocks(source), [(i, 10) for i in range(3)])
+                   for source in 'abc']
+        fetcher = BlockFetcher(sources, lambda worker, request: request.result(), 2, 15)
+        blocks = list(fetcher)
+        self.assertEqual(sorted(blocks), [(source, i) for source in 'abc' for i in range(3)])
+        # requests are issued round robin
+        self.assertEqual(issued[:3], list('abc'))
+        self.assertEqual(fetcher.requests, 9)
+        self.assertEqual(fetcher.bytes_received, 90)
+
+
+    def test_encode_key(self):
+        keys = [None, -2 ** 70, -256, -1, 0, 1, 255, 2 ** 70, float('-inf'), -1.5, 0.0, 1e-300,
+                1.5, b'', b'\x00', b'a', b'a\x00', '', 'a', 'a\x00', 'ab', 'b', '\xe9',
+                (), (0, 'z'), (1,), (1, 2), ('a',), ('a', 1), ('a\x00',)]
+        self.assertEqual(sorted(keys, key=encode_key), keys)
+
+        # numpy scalars and bools are encoded like the equal python numbers
+        self.assertEqual(encode_key(np.int64(-3)), encode_key(-3))
+        self.assertEqual(encode_key(np.uint8(255)), encode_key(255))
+        self.assertEqual(encode_key(np.float64(1.5)), encode_key(1.5))
+        self.assertEqual(encode_key(np.float32(.5)), encode_key(.5))
+        self.assertEqual(encode_key(True), encode_key(1))
+        self.assertEqual(encode_key(np.bool_(False)), encode_key(0))
+        self.assertEqual(encode_key((np.int32(1), 'a')), encode_key((1, 'a')))
+        values = np.array([3, -1, 2 ** 40, 0])
+        self.assertEqual(sorted(values, key=encode_key), sorted(values))
+
+
+    def test_encoded_keys(self):
+        dset = self.ctx.range(100 * 1000, pcount=self.worker_count * 2)
+        self.assertEqual(dset.map(lambda i: (str(i % 997), -i)).sort(bucket=EncodedSortedBucket).collect(),
+                         sorted(dset.map(lambda i: (str(i % 997), -i)).collect()))
+        self.assertEqual(sorted(dset.map(lambda i: (i % 100, 1))
+                                    .aggregate_by_key(sum, bucket=EncodedSortedBucket).collect()),
+                         [(i, 1000) for i in range(100)])
+        arrays = dset.map_partitions(lambda part: np.array(list(part)) % 997)
+        self.assertEqual(list(arrays.sort(bucket=EncodedSortedBucket).collect()),
+                         sorted(i % 997 for i in range(100 * 1000)))
+
+
+    def test_numpy_partitions(self):
+        size = 10 * 1000
+        values = self.ctx.range(size, pcount=self.worker_count * 2).map(lambda i: (i * 7919) % size)
+        arrays = values.map_partitions(lambda part: np.array(list(part)))
+        self.assertEqual(list(arrays.sort().collect()), list(range(size)))
+        self.assertEqual(sorted(arrays.shuffle(pcount=5, sort=False).collect()), list(range(size)))
+
+        rows = arrays.map_partitions(lambda part: np.stack([part % 10, part], axis=1))
+        parts = rows.shuffle(pcount=3, key=0, sort=False).collect(parts=True)
+        self.assertEqual(sorted(row[1] for row in chain.from_iterable(parts)), list(range(size)))
+        for part in parts:
+            self.assertLessEqual(len(set(row[0] for row in part)), 4)
+        self.assertEqual([row[1] for row in rows.sort(key=1).collect()], list(range(size)))
+
+
+    def test_record_buckets(self):
+        size = 100 * 1000
+        dset = self.ctx.range(size, pcount=self.worker_count * 2) \
+                       .map(lambda i: ('k%s' % (i % 997), i * .5, i))
+        expected = sorted(dset.collect())
+        self.assertEqual(dset.sort().collect(), expected)
+        self.assertEqual(dset.sort(key=2).collect(), sorted(expected, key=lambda r: r[2]))
+        self.assertEqual(sorted(dset.shuffle(sort=False).collect()), expected)
+        # records which are not alike are kept as is
+        mixed = dset.map(lambda r: r if r[2] % 1000 else (r[0], None, r[2]))
+        self.assertEqual(mixed.sort(key=2).map(lambda r: r[2]).collect(), list(range(size)))
+
+        # records are only used with pickle serialization
+        for serialization in ('marshal', 'json'):
+            self.assertEqual(sorted(map(tuple, dset.sort(serialization=serialization).collect())),
+                             expected)
+            self.assertEqual(sorted(map(tuple, dset.shuffle(sort=False, serialization=serialization)
+                                                   .collect())),
+                             expected)
+
+        bucket = RecordBucket(('test',), None, None, 4, None, None)
+        bucket.extend(('k%s' % i, i) for i in range(1000))
+        self.assertIsNotNone(bucket.records)
+        self.assertLess(bucket.memory_size, 20 * 1000)
+
+
+    def test_spill_writer(self):
+        dset = self.ctx.range(10)
+        shuffle = dset.shuffle().src
+        buckets = [ListBucket(('test', idx), None, None, 4, shuffle.memory_container,
+                              shuffle.disk_container) for idx in range(3)]
+        writer = SpillWriter(('test', 'spill'), 2)
+        try:
+            for spill in range(5):
+                for bucket in buckets:
+                    bucket.extend(range(spill * 10, spill * 10 + 10))
+                writer.spill(buckets)
+                # the elements are detached from the buckets and at most 2 spills are in flight
+                self.assertEqual(sum(map(len, buckets)), 0)
+                self.assertLessEqual(len(writer.pending), 2)
+            writer.flush()
+        finally:
+            writer.close()
+        self.assertGreater(writer.bytes_spilled, 0)
+        for bucket in buckets:
+            self.assertEqual(len(bucket.batches), 5)
+            # the element size estimated while spilling isn't written back to the live bucket
+            self.assertIsNone(bucket.element_size)
+            self.assertEqual(sorted(chain.from_iterable(block.read() for batch in bucket.batches
+                                                        for block in batch)),
+                             list(range(50)))
+
+
+    def test_estimate_size(self):
+        shuffle = self.ctx.range(10).shuffle().src
+        bucket = ListBucket(('test',), None, None, 4, shuffle.memory_container,
+                            shuffle.disk_container)
+        bucket.extend('x' * 1000 for _ in range(100))
+        # memory_size is a count of the elements until the bucket is serialized
+        self.assertEqual(bucket.memory_size, 100)
+        self.assertGreater(bucket.estimate_size(), 100 * 1000)
+        # the estimate doesn't affect the serialized element size used to split blocks
+        self.assertIsNone(bucket.element_size)
+        self.assertEqual(bucket.memory_size, 100)
+
+
+    def test_plan_partitions(self):
+        sizes = {0: [1, 1, 1, 100, 1, 1], 1: [1, 1, 1, 100, 1, 1], 2: [0, 0, 0, 100, 0, 0]}
+        self.assertEqual(plan_partitions(6, sizes, 10, False),
+                         [[(0, None), (1, None), (2, None)], [], [], [(3, None)],
+                          [(4, None), (5, None)], []])
+        self.assertEqual(plan_partitions(6, sizes, 10, True),
+                         [[(0, None), (1, None), (2, None)], [(3, [1])], [(3, [2])], [(3, [0])],
+                          [(4, None), (5, None)], []])
+
+
     @classmethod
     def _setup_tests(cls):
         sizes = [1000, 1000 * 1000]
@@ -78,6 +293,39 @@ class ShuffleTest(DatasetTest):
 
 
 
+class LocalReadsTest(DatasetTest):
+    # two of the three workers listen on 127.0.0.1 and read from each other locally
+    worker_count = 3
+
+    def _bytes_written(self):
+        return sum(stats['bytes_written']
+                   for worker in self.ctx.workers
+                   for stats in worker.service('shuffle').get_io_stats().result().values())
+
+
+    def _test_local_reads(self, local_reads):
+        self.ctx.conf['bndl.compute.shuffle.local_reads'] = local_reads
+        try:
+            dset = self.ctx.range(10 * 1000, pcount=self.worker_count * 2).map(lambda i: (i % 100, i))
+            written = self._bytes_written()
+            self.assertEqual(sorted(dset.aggregate_by_key(sum, pcount=6).collect()),
+                             [(k, sum(range(k, 10 * 1000, 100))) for k in range(100)])
+            return self._bytes_written() - written
+        finally:
+            self.ctx.conf['bndl.compute.shuffle.local_reads'] = True
+
+
+    def test_local_reads(self):
+        # the in memory map outputs are written to the work dir for the local reads
+        self.assertGreater(self._test_local_reads(True), 0)
+
+
+    def test_no_local_reads(self):
+        # the (small) map outputs stay in memory and are sent over the network
+        self.assertEqual(self._test_local_reads(False), 0)
+
+
+
 class ShuffleFailureTest(DatasetTest):
     worker_count = 20
 
@@ -39,3 +39,33 @@ class SortTest(DatasetTest):
         col = [random.randint(1, maxint) for _ in range(length)]
         dset = self.ctx.collection(col).key_by(identity).map(list)
         self.assertEqual(dset.sort().values().collect(), sorted(col))
+
+
+    def test_sort_single_pass(self):
+        computed = self.ctx.accumulator(0)
+
+        def count(i):
+            nonlocal computed
+            computed += 1
+            return i
+
+        col = [random.randint(1, 1000) for _ in range(1000)]
+        dset = self.ctx.collection(col, pcount=4).map(count)
+        self.assertEqual(dset.sort(pcount=3).collect(), sorted(col))
+        self.assertEqual(computed.value, len(col))
+        self.assertEqual(dset.sort(pcount=3, key=lambda i: -i).collect(), sorted(col, reverse=True))
+
+
+    def test_sort_skewed(self):
+        col = [0] * 900 + list(range(1, 101))
+        random.shuffle(col)
+        parts = self.ctx.collection(col, pcount=4).sort(pcount=4).collect(parts=True)
+        self.assertEqual([e for part in parts for e in part], sorted(col))
+        # the hot key is sampled as often as it occurs and gets a partition of its own
+        self.assertIn([0] * 900, parts)
+
+
+    def test_sort_adaptive(self):
+        col = [random.randint(1, 1000) for _ in range(1000)]
+        dset = self.ctx.collection(col, pcount=4)
+        self.assertEqual(dset.sort(pcount=3, adaptive=True).collect(), sorted(col))
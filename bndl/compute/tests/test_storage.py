@@ -14,8 +14,10 @@ from unittest.case import TestCase
 import asyncio
 import random
 import string
+import tempfile
 
-from bndl.compute.storage import StorageContainerFactory
+from bndl.compute import storage
+from bndl.compute.storage import StorageContainerFactory, DataFile, WorkDir
 from bndl.net.connection import Connection
 from bndl.util.aio import get_loop, run_coroutine_threadsafe
 
@@ -62,3 +64,62 @@ class StorageTest(TestCase):
             self.assertEqual(to_disk.read(), c.read())
 
         run_coroutine_threadsafe(run_pair(), self.loop).result()
+
+
+    def test_send_segments(self):
+        data_file = DataFile(('segments',))
+        provider = StorageContainerFactory('disk', 'pickle')
+        segments = [data_file.segment(provider)(('segments', str(i))) for i in range(3)]
+        for i, segment in enumerate(segments):
+            segment.write(self.data[i::3])
+        to_segment = StorageContainerFactory('memory', 'pickle')('d')
+        to_segment.write(self.data)
+        to_segment.to_disk(data_file)
+        data_file.close()
+
+        containers = segments + [to_segment]
+        self.assertEqual(len(set(c.filepath for c in containers)), 1)
+
+        def connected(reader, writer):
+            conn = Connection(self.loop, reader, writer)
+            for container in containers:
+                yield from conn.send(container)
+
+        @asyncio.coroutine
+        def run_pair():
+            server = yield from asyncio.start_server(connected, '0.0.0.0', 0, loop=self.loop)
+            socket = server.sockets[0]
+            host, port = socket.getsockname()[:2]
+
+            reader, writer = yield from asyncio.open_connection(host, port, loop=self.loop)
+            conn = Connection(self.loop, reader, writer)
+            for container in containers:
+                received = yield from conn.recv()
+                self.assertEqual(container.read(), received.read())
+
+        run_coroutine_threadsafe(run_pair(), self.loop).result()
+
+
+    def test_work_dirs(self):
+        work_dirs = storage._work_dirs
+        with tempfile.TemporaryDirectory() as dir1, tempfile.TemporaryDirectory() as dir2:
+            storage._work_dirs = [WorkDir(dir1), WorkDir(dir2)]
+            try:
+                provider = StorageContainerFactory('disk', 'pickle')
+                containers = [provider(('work_dirs', str(i))) for i in range(4)]
+                for container in containers:
+                    container.write(self.data)
+                    self.assertEqual(container.read(), self.data)
+                # the containers are spread round robin over the work dirs
+                self.assertEqual(sum(c.filepath.startswith(dir1) for c in containers), 2)
+                self.assertEqual(sum(c.filepath.startswith(dir2) for c in containers), 2)
+
+                stats = storage.work_dir_stats()
+                self.assertEqual(set(stats), {dir1, dir2})
+                for work_dir_stats in stats.values():
+                    self.assertEqual(work_dir_stats['writes'], 2)
+                    self.assertEqual(work_dir_stats['reads'], 2)
+                    self.assertEqual(work_dir_stats['pending'], 0)
+                    self.assertEqual(work_dir_stats['bytes_read'], work_dir_stats['bytes_written'])
+            finally:
+                storage._work_dirs = work_dirs
@@ -42,3 +42,12 @@ class TreeAggregateTest(DatasetTest):
         for d in range(2, 5):
             self.assertEqual(self.dset.tree_aggregate(sum, depth=d),
                              self.dset.sum())
+
+    def test_strategy(self):
+        for strategy in ('workers', 'shuffle'):
+            for scale in (None, 2, 3):
+                self.assertEqual(self.dset.tree_aggregate(sum, strategy=strategy, scale=scale),
+                                 self.dset.sum())
+        self.assertEqual(self.dset.filter(lambda i: False).tree_aggregate(sum), 0)
+        with self.assertRaises(ValueError):
+            self.dset.tree_aggregate(sum, strategy='driver')
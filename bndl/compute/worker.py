@@ -18,6 +18,7 @@ import os
 import signal
 import threading
 
+from bndl.compute.aggregate import AggregateManager
 from bndl.compute.blocks import BlockManager
 from bndl.compute.broadcast import BroadcastManager
 from bndl.compute.memory import LocalMemoryManager, MemorySupervisor
@@ -37,6 +38,7 @@ logger = logging.getLogger(__name__)
 class Worker(ExecutionWorker):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.services['aggregate'] = AggregateManager(self)
         self.services['blocks'] = BlockManager(self)
         self.services['broadcast'] = BroadcastManager(self)
         self.services['shuffle'] = ShuffleManager(self)
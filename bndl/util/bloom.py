@@ -0,0 +1,108 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from math import ceil, log
+
+import numpy as np
+
+from bndl.util.hash import portable_hashes
+
+
+class BloomFilter(object):
+    '''
+    A Bloom filter over (portable_hash-able) keys. Keys are added and tested in batches,
+    the bit positions are computed vectorized with double hashing of portable_hash.
+
+    Filters with the same capacity and error rate (and thus the same size) can be merged with
+    | (union).
+
+    :param capacity: int
+        The number of (distinct) keys expected to be added.
+    :param error_rate: float
+        The false positive rate at capacity.
+    '''
+    def __init__(self, capacity, error_rate=0.01):
+        if not 0 < error_rate < 1:
+            raise ValueError('error_rate must be between 0 and 1, not %r' % error_rate)
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(ceil(-capacity * log(error_rate) / log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / capacity * log(2))))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+
+
+    def _positions(self, keys):
+        h1 = portable_hashes(keys)
+        # the second hash is derived from the first by another round of mixing
+        h2 = portable_hashes(h1)
+        with np.errstate(over='ignore'):
+            h1 = h1.view(np.uint64)
+            h2 = h2.view(np.uint64) | np.uint64(1)
+            size = np.uint64(self.size)
+            return [(h1 + np.uint64(i) * h2) % size for i in range(self.hash_count)]
+
+
+    def update(self, keys):
+        '''
+        Add the keys to the filter.
+        '''
+        for positions in self._positions(keys):
+            masks = np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8))
+            np.bitwise_or.at(self.bits, positions >> np.uint64(3), masks)
+
+
+    def add(self, key):
+        self.update([key])
+
+
+    def contains(self, keys):
+        '''
+        Test for each of the keys whether it (probably) was added to the filter.
+
+        :return: A numpy array of booleans.
+        '''
+        found = None
+        for positions in self._positions(keys):
+            offsets = (positions & np.uint64(7)).astype(np.uint8)
+            bits = (self.bits[positions >> np.uint64(3)] >> offsets) & np.uint8(1)
+            found = bits.astype(bool) if found is None else found & bits.astype(bool)
+        return found
+
+
+    def __contains__(self, key):
+        return bool(self.contains([key])[0])
+
+
+    def __or__(self, other):
+        merged = self.copy()
+        merged |= other
+        return merged
+
+
+    def __ior__(self, other):
+        if self.size != other.size or self.hash_count != other.hash_count:
+            raise ValueError('Can\'t merge Bloom filters of different size')
+        np.bitwise_or(self.bits, other.bits, out=self.bits)
+        return self
+
+
+    def copy(self):
+        copy = BloomFilter.__new__(BloomFilter)
+        copy.__dict__.update(self.__dict__)
+        copy.bits = self.bits.copy()
+        return copy
+
+
+    def __repr__(self):
+        return '<BloomFilter capacity=%s error_rate=%s size=%s hashes=%s>' % (
+            self.capacity, self.error_rate, self.size, self.hash_count)
@@ -26,7 +26,7 @@ def batch(iterable, size):
             iterable = iter(iterable)
             l = list(islice(iterable, size))
             if len(l) == 0:
-                raise StopIteration()
+                return
             else:
                 yield l
 
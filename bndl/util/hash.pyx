@@ -10,11 +10,181 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+'''
+Deterministic hashing of (keys of) elements, e.g. for partitioning elements in a shuffle.
+
+Unlike the builtin hash, portable_hash doesn't depend on PYTHONHASHSEED or on the version of
+the interpreter for None, bool, int, float, str, bytes and tuples thereof. str and bytes are
+hashed with MurmurHash3 (x86, 32 bit, the same as mmh3.hash), integers with the 64 bit
+finalizer of MurmurHash3. As with the builtin hash, numbers which compare equal (e.g. 1, 1.0
+and True) have the same hash. Other objects are hashed with the builtin hash, which is only
+deterministic if PYTHONHASHSEED is set; portable_hash raises a RuntimeError for such objects if
+it isn't.
+'''
+
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_GET_SIZE
+from cpython.float cimport PyFloat_AS_DOUBLE
 from cpython.object cimport PyObject_Hash
+from libc.math cimport floor, isinf, isnan
+from libc.stdint cimport int32_t, int64_t, uint32_t, uint64_t
 
+import os
 
-cpdef long portable_hash(obj) except -1:
-    if obj is None:
+import numpy as np
+
+
+cdef extern from "Python.h":
+    const char* PyUnicode_AsUTF8AndSize(object unicode, Py_ssize_t *size) except NULL
+    long long PyLong_AsLongLongAndOverflow(object pylong, int *overflow) except? -1
+
+
+# whether the builtin hash is the same across processes
+cdef bint _hash_seeded = (os.environ.get('PYTHONHASHSEED') or 'random') != 'random'
+
+
+cdef inline uint32_t rotl32(uint32_t x, int r) nogil:
+    return (x << r) | (x >> (32 - r))
+
+
+cdef inline uint64_t fmix64(uint64_t k) nogil:
+    k ^= k >> 33
+    k *= 0xff51afd7ed558ccdULL
+    k ^= k >> 33
+    k *= 0xc4ceb9a62d5aa0d5ULL
+    k ^= k >> 33
+    return k
+
+
+cdef int32_t murmur3_32(const unsigned char *data, Py_ssize_t length, uint32_t seed) nogil:
+    cdef uint32_t c1 = 0xcc9e2d51U
+    cdef uint32_t c2 = 0x1b873593U
+    cdef uint32_t h = seed
+    cdef uint32_t k
+    cdef Py_ssize_t nblocks = length // 4
+    cdef Py_ssize_t i
+    cdef const unsigned char *tail
+
+    for i in range(nblocks):
+        k = (<uint32_t>data[i * 4] |
+             <uint32_t>data[i * 4 + 1] << 8 |
+             <uint32_t>data[i * 4 + 2] << 16 |
+             <uint32_t>data[i * 4 + 3] << 24)
+        k *= c1
+        k = rotl32(k, 15)
+        k *= c2
+        h ^= k
+        h = rotl32(h, 13)
+        h = h * 5 + 0xe6546b64U
+
+    tail = data + nblocks * 4
+    k = 0
+    if length & 3 == 3:
+        k ^= <uint32_t>tail[2] << 16
+    if length & 3 >= 2:
+        k ^= <uint32_t>tail[1] << 8
+    if length & 3 >= 1:
+        k ^= <uint32_t>tail[0]
+        k *= c1
+        k = rotl32(k, 15)
+        k *= c2
+        h ^= k
+
+    h ^= <uint32_t>length
+    h ^= h >> 16
+    h *= 0x85ebca6bU
+    h ^= h >> 13
+    h *= 0xc2b2ae35U
+    h ^= h >> 16
+    return <int32_t>h
+
+
+cdef int64_t _hash_int(obj) except? -1:
+    cdef int overflow = 0
+    cdef long long value = PyLong_AsLongLongAndOverflow(obj, &overflow)
+    if overflow:
+        data = obj.to_bytes((obj.bit_length() + 8) // 8, 'little', signed=True)
+        return murmur3_32(<const unsigned char*>PyBytes_AS_STRING(data), PyBytes_GET_SIZE(data), 0)
+    return <int64_t>fmix64(<uint64_t>value)
+
+
+cdef int64_t _hash_float(obj) except? -1:
+    cdef double value = PyFloat_AS_DOUBLE(obj)
+    if isnan(value):
         return 0
+    elif isinf(value) or floor(value) != value:
+        return murmur3_32(<const unsigned char*>&value, sizeof(double), 0)
+    elif -9.2e18 < value < 9.2e18:
+        # integral floats hash the same as the equal int
+        return <int64_t>fmix64(<uint64_t><int64_t>value)
     else:
+        return _hash_int(int(value))
+
+
+cpdef int64_t portable_hash(obj) except? -1:
+    '''
+    Deterministic hash of obj; see the module documentation.
+    '''
+    cdef const char *data
+    cdef Py_ssize_t size
+    cdef uint64_t h
+
+    if obj is None:
+        return 0
+    elif isinstance(obj, str):
+        data = PyUnicode_AsUTF8AndSize(obj, &size)
+        return murmur3_32(<const unsigned char*>data, size, 0)
+    elif isinstance(obj, bytes):
+        return murmur3_32(<const unsigned char*>PyBytes_AS_STRING(obj), PyBytes_GET_SIZE(obj), 0)
+    elif isinstance(obj, int):
+        return _hash_int(obj)
+    elif isinstance(obj, float):
+        return _hash_float(obj)
+    elif isinstance(obj, (np.integer, np.bool_)):
+        # numpy scalars hash the same as the equal python numbers
+        return _hash_int(int(obj))
+    elif isinstance(obj, np.floating):
+        return _hash_float(float(obj))
+    elif isinstance(obj, tuple):
+        h = <uint64_t>len(obj)
+        for item in obj:
+            h = fmix64(h * 1000003 + <uint64_t>portable_hash(item))
+        return <int64_t>h
+    elif _hash_seeded:
         return PyObject_Hash(obj)
+    else:
+        raise RuntimeError('Unable to hash %s portably, PYTHONHASHSEED must be set for objects '
+                           'other than None, bool, int, float, str, bytes and tuples thereof'
+                           % type(obj))
+
+
+def portable_hashes(values):
+    '''
+    Compute portable_hash for each of the values.
+
+    :param values: sequence or iterable
+        The values to hash. Numpy arrays of integers or booleans are hashed vectorized.
+    :return: A numpy array of int64 hashes.
+    '''
+    if isinstance(values, np.ndarray) and values.ndim == 1 and values.dtype.kind in 'biu':
+        with np.errstate(over='ignore'):
+            k = values.astype(np.int64).view(np.uint64)
+            k = k ^ (k >> np.uint64(33))
+            k = k * np.uint64(0xff51afd7ed558ccd)
+            k = k ^ (k >> np.uint64(33))
+            k = k * np.uint64(0xc4ceb9a62d5aa0d5)
+            k = k ^ (k >> np.uint64(33))
+        mixed = k.view(np.int64)
+        if values.dtype.kind == 'u' and values.dtype.itemsize == 8:
+            # unsigned values beyond the range of int64 are hashed as big ints
+            for big in np.flatnonzero(values > np.uint64(2 ** 63 - 1)):
+                mixed[big] = portable_hash(int(values[big]))
+        return mixed
+
+    if not isinstance(values, (list, tuple)):
+        values = list(values)
+    hashes = np.empty(len(values), dtype=np.int64)
+    cdef int64_t[:] out = hashes
+    cdef Py_ssize_t i
+    for i, value in enumerate(values):
+        out[i] = portable_hash(value)
+    return hashes
@@ -0,0 +1,46 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest.case import TestCase
+import pickle
+
+import numpy as np
+
+from bndl.util.bloom import BloomFilter
+
+
+class BloomFilterTest(TestCase):
+    def test_membership(self):
+        bloom = BloomFilter(10000, .01)
+        bloom.update(range(10000))
+        self.assertTrue(bloom.contains(list(range(10000))).all())
+        self.assertLess(bloom.contains(list(range(10000, 110000))).mean(), .02)
+        self.assertEqual(len(bloom.contains([])), 0)
+
+    def test_keys(self):
+        bloom = BloomFilter(100)
+        bloom.update(['a', b'b', (1, 'c'), None])
+        bloom.update(np.arange(10))
+        for key in ('a', b'b', (1, 'c'), None, 5, 5.0):
+            self.assertIn(key, bloom)
+        self.assertIn('a', pickle.loads(pickle.dumps(bloom)))
+
+    def test_merge(self):
+        a, b = BloomFilter(100), BloomFilter(100)
+        a.add('a')
+        b.add('b')
+        merged = a | b
+        self.assertIn('a', merged)
+        self.assertIn('b', merged)
+        self.assertNotIn('b', a)
+        with self.assertRaises(ValueError):
+            a |= BloomFilter(1000)
@@ -0,0 +1,91 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest.case import TestCase
+import os
+import subprocess
+import sys
+
+import mmh3
+import numpy as np
+
+from bndl.util.hash import portable_hash, portable_hashes
+
+
+class HashTest(TestCase):
+    values = [None, True, False, 0, 1, -1, 2 ** 63 - 1, -2 ** 63, 2 ** 70, -2 ** 70,
+              1.5, -3.0, 1e19, '', 'a', 'abcde', '\xe9', b'', b'abc',
+              (), (1, 'a'), ('a', (None, 2.5))]
+
+    def test_murmur(self):
+        for value in ('', 'a', 'ab', 'abc', 'abcd', 'abcde', 'h\xe9llo w\xf6rld'):
+            self.assertEqual(portable_hash(value), mmh3.hash(value))
+            self.assertEqual(portable_hash(value.encode()), mmh3.hash(value.encode()))
+
+    def test_equal_numbers(self):
+        self.assertEqual(portable_hash(1), portable_hash(1.0))
+        self.assertEqual(portable_hash(1), portable_hash(True))
+        self.assertEqual(portable_hash(1e19), portable_hash(int(1e19)))
+        self.assertEqual(portable_hash((1, 'a')), portable_hash((1.0, 'a')))
+
+    def test_deterministic(self):
+        # hashes don't depend on the hash seed of the interpreter
+        script = 'from bndl.util.hash import portable_hash; print([portable_hash(v) for v in %r])'
+        outputs = set()
+        for seed in ('1', '2'):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            outputs.add(subprocess.check_output([sys.executable, '-c', script % self.values], env=env))
+        self.assertEqual(len(outputs), 1)
+
+    def test_unseeded(self):
+        # other objects are hashed with the builtin hash only if the hash seed is fixed
+        script = 'import datetime; from bndl.util.hash import portable_hash; ' \
+                 'print(portable_hash(datetime.date(2000, 1, 1)))'
+        env = dict(os.environ, PYTHONHASHSEED='1')
+        subprocess.check_output([sys.executable, '-c', script], env=env)
+        env = dict(os.environ, PYTHONHASHSEED='random')
+        with self.assertRaises(subprocess.CalledProcessError):
+            subprocess.check_output([sys.executable, '-c', script], env=env,
+                                    stderr=subprocess.DEVNULL)
+        script = 'from bndl.util.hash import portable_hash; print(portable_hash((1, "a")))'
+        subprocess.check_output([sys.executable, '-c', script], env=env)
+
+    def test_batch(self):
+        expected = [portable_hash(value) for value in self.values]
+        self.assertEqual(portable_hashes(self.values).tolist(), expected)
+        self.assertEqual(portable_hashes(iter(self.values)).tolist(), expected)
+        ints = np.array([0, 1, -1, 2 ** 63 - 1, -2 ** 63, 12345])
+        self.assertEqual(portable_hashes(ints).tolist(), [portable_hash(int(i)) for i in ints])
+        bools = np.array([True, False])
+        self.assertEqual(portable_hashes(bools).tolist(), [portable_hash(True), portable_hash(False)])
+
+    def test_numpy_scalars(self):
+        for k in (0, 1, -1, 5, 2 ** 40, 2 ** 63 - 1):
+            self.assertEqual(portable_hash(np.int64(k)), portable_hash(k))
+            if abs(k) < 2 ** 24:
+                self.assertEqual(portable_hash(np.float32(k)), portable_hash(k))
+        for k in (0, 5, 2 ** 63, 2 ** 64 - 1):
+            self.assertEqual(portable_hash(np.uint64(k)), portable_hash(k))
+        self.assertEqual(portable_hash(np.bool_(True)), portable_hash(True))
+        self.assertEqual(portable_hash((np.int32(1), 'a')), portable_hash((1, 'a')))
+
+    def test_batch_dtypes(self):
+        arrays = [
+            np.array([0, 1, -1, 5, 2 ** 63 - 1, -2 ** 63], dtype=np.int64),
+            np.array([0, 5, -7], dtype=np.int8),
+            np.array([0, 5, 2 ** 32 - 1], dtype=np.uint32),
+            np.array([0, 5, 2 ** 63, 2 ** 64 - 1], dtype=np.uint64),
+            np.array([True, False]),
+        ]
+        for arr in arrays:
+            self.assertEqual(portable_hashes(arr).tolist(), [portable_hash(x) for x in arr])
+            self.assertEqual(portable_hashes(arr).tolist(), [portable_hash(x) for x in arr.tolist()])